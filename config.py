@@ -1,2 +1,4 @@
-
 ODOO_PATH = '../odoo'
+CACHE_PATH = '~/.cache/transform_coa'
+CACHE_SIZE = 512 * 1024 * 1024  # bytes
+WRITE_THREADS = 8  # threads writing the changed files at the end of a run
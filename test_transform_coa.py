@@ -0,0 +1,62 @@
+# pylint: skip-file
+import ast
+import os
+from pathlib import Path
+import shlex
+import tempfile
+import unittest
+
+from config import ODOO_PATH
+import transform_coa
+from transform_synthetic import generate_addons
+from transform_tools import l10n_addons, select_modules
+
+
+class AddonsTestCase(unittest.TestCase):
+    """The odoo package must be importable beforehand, the addons are generated in a temporary tree."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        run_path = Path(tmp.name) / 'run'
+        run_path.mkdir()
+        self.odoo_path = run_path / ODOO_PATH
+        self.addons_path = self.odoo_path / 'addons'
+        generate_addons(self.addons_path, modules=2, accounts=20)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(run_path)
+        self.addCleanup(transform_coa.forget_tree)
+
+
+class TestSelectModules(AddonsTestCase):
+
+    def test_no_path_selects_all_modules(self):
+        # What fw-port sends without an addon path
+        self.assertIsNone(select_modules(shlex.split('')))
+
+    def test_odoo_path_selects_all_modules(self):
+        self.assertEqual(select_modules([f'{self.odoo_path}/']), list(l10n_addons()))
+
+    def test_addon_path_selects_the_addon(self):
+        addon = next(iter(l10n_addons()))
+        self.assertEqual(select_modules([str(self.addons_path / addon / '__manifest__.py')]), [addon])
+
+
+class TestWatch(AddonsTestCase):
+
+    def test_watch_step_keeps_the_sources_in_the_manifest(self):
+        sources = {path: path.read_bytes() for path in self.addons_path.glob('l10n_*/data/*') if path.is_file()}
+
+        transform_coa.watch_step({}, use_cache=False)
+
+        for path, content in sources.items():
+            self.assertEqual(path.read_bytes(), content, f"{path} was modified")
+        for addon in sorted(self.addons_path.glob('l10n_*')):
+            manifest = ast.literal_eval((addon / '__manifest__.py').read_text(encoding='utf-8'))
+            data_files = {f'data/{path.name}' for path in (addon / 'data').iterdir() if path.is_file()}
+            self.assertEqual(set(manifest.get('data', ())), data_files, f"data of {addon.name}")
+            self.assertTrue((addon / 'models' / '__init__.py').exists())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# pylint: skip-file
+
+import argparse
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import tempfile
+import time
+import tracemalloc
+
+from config import ODOO_PATH
+import transform_coa
+from transform_cache import cache
+from transform_csv import convert_csv_to_records, convert_records_to_csv
+from transform_synthetic import generate_addons
+from transform_tools import l10n_addons, module_files, pformat
+
+
+def timed(func, setup=None, repeat=3):
+    """
+        Best wall time of `repeat` calls, in seconds.
+        `setup` returns the arguments of each call, it isn't timed.
+    """
+    durations = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+def print_scaling(title, unit, results):
+    """Print the timings of a stage for growing sizes, the time per unit should stay flat if it scales linearly."""
+    print(title)
+    print(f"    {unit:>10} {'time (ms)':>12} {'per unit (us)':>14}")
+    for size, duration in results:
+        print(f"    {size:>10} {duration * 1e3:>12.2f} {duration / size * 1e6:>14.2f}")
+
+def print_memory(title, unit, results):
+    """Print the memory retained and the peak memory of a stage for growing sizes."""
+    print(title)
+    print(f"    {unit:>10} {'retained (MB)':>14} {'peak (MB)':>10} {'per unit (kB)':>14}")
+    for size, retained, peak in results:
+        print(f"    {size:>10} {retained / 2**20:>14.2f} {peak / 2**20:>10.2f} {retained / size / 2**10:>14.2f}")
+
+# pformat ---------------------------------------------------
+
+def repartition_lines(tax):
+    return [
+        (0, 0, {'repartition_type': 'base', 'document_type': document_type, 'tag_ids': f'+{tax}'})
+        for document_type in ('invoice', 'refund')
+    ] + [
+        (0, 0, {'repartition_type': 'tax', 'document_type': document_type, 'account_id': f'a{tax}', 'tag_ids': f'-{tax}'})
+        for document_type in ('invoice', 'refund')
+    ]
+
+def nested_value(depth):
+    value = {'name': 'leaf', 'amount': 21.0}
+    for level in range(depth):
+        value = {'sequence': level, 'line_ids': [(0, 0, value)], 'tax_ids': [(6, 0, ['vat_21', 'vat_6'])]}
+    return value
+
+def tax_records(count):
+    return {
+        f'tax_{i}': {
+            'name': f'VAT {i}%',
+            'amount': float(i),
+            'price_include': False,
+            'repartition_line_ids': repartition_lines(i),
+        }
+        for i in range(count)
+    }
+
+def bench_pformat(scale=1, modules=None):
+    """Format values of growing sizes, `modules` is ignored as no localization is involved."""
+    print_scaling("pformat, nesting depth", 'depth', [
+        (depth, timed(lambda: pformat(value)))
+        for depth in (10 * scale, 20 * scale, 40 * scale, 80 * scale)
+        for value in [nested_value(depth)]
+    ])
+    print_scaling("pformat, tax records", 'records', [
+        (count, timed(lambda: pformat(records, level=2)))
+        for count in (250 * scale, 500 * scale, 1000 * scale, 2000 * scale)
+        for records in [tax_records(count)]
+    ])
+
+# stages ----------------------------------------------------
+
+def reset():
+    """Forget everything read from the addons and the changes staged by a previous call."""
+    transform_coa.forget_tree()
+
+@contextmanager
+def synthetic_addons(accounts, modules=2):
+    """
+        Work in a temporary Odoo tree with generated localizations of `accounts` accounts.
+        The odoo package must be importable beforehand, only the addons are replaced.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        run_path = Path(tmp) / 'run'
+        run_path.mkdir()
+        generate_addons(run_path / ODOO_PATH / 'addons', modules, accounts)
+        os.chdir(run_path)
+        reset()
+        try:
+            yield
+        finally:
+            os.chdir(cwd)
+            reset()
+
+def collected_records(cleanup_tax_tags=False):
+    """Records as read_data has them before the tax tags are cleaned up, or before the children are linked."""
+    reset()
+    all_records = transform_coa.collect_records()
+    for (module, template), records in all_records.items():
+        transform_coa.split_template_from_company(records, module)
+    if cleanup_tax_tags:
+        transform_coa.cleanup_tax_tags(all_records)
+    return all_records
+
+def read_records():
+    reset()
+    return transform_coa.read_data()
+
+def template_records(all_records):
+    return [records for (module, template), records in all_records.items() if template]
+
+def xml_files():
+    reset()
+    return [filename for module in l10n_addons() for filename in module_files(module)['data_xml']]
+
+def stage_parse_file(filenames):
+    for filename in filenames:
+        for _record in transform_coa.parse_file(filename):
+            pass
+
+def stage_convert_csv_to_records():
+    for model in transform_coa.CSV_MODELS:
+        convert_csv_to_records(model)
+
+def stage_convert_records_to_csv(all_records):
+    for records in template_records(all_records):
+        for model in ['account.account', 'account.group', 'account.tax.group', 'account.tax', 'account.fiscal.position']:
+            convert_records_to_csv(records, model)
+
+def stage_convert_records_to_function(all_records):
+    for records in template_records(all_records):
+        for model in ['account.chart.template', 'account.reconcile.model', 'account.fiscal.position.tax', 'account.fiscal.position.account']:
+            transform_coa.convert_records_to_function(records, model, 'function', 'template', one_level=model == 'account.chart.template')
+
+def stage_load_translations():
+    for module in l10n_addons():
+        transform_coa.load_translations(module)
+
+# name: (function, setup returning its arguments)
+STAGES = {
+    'parse_file': (stage_parse_file, lambda: (xml_files(),)),
+    'convert_csv_to_records': (stage_convert_csv_to_records, reset),
+    'read_data': (transform_coa.read_data, reset),
+    'cleanup_tax_tags': (transform_coa.cleanup_tax_tags, lambda: (collected_records(),)),
+    'link_children': (transform_coa.link_children, lambda: (collected_records(cleanup_tax_tags=True),)),
+    'convert_records_to_csv': (stage_convert_records_to_csv, lambda: (read_records(),)),
+    'convert_records_to_function': (stage_convert_records_to_function, lambda: (read_records(),)),
+    'load_translations': (stage_load_translations, reset),
+}
+
+def bench_stages(names, scale=1, modules=2):
+    """Time the stages on generated localizations of growing sizes, the addons are generated once per size."""
+    cache.enabled = False
+    sizes = (100 * scale, 200 * scale, 400 * scale, 800 * scale)
+    results = {name: [] for name in names}
+    for accounts in sizes:
+        with synthetic_addons(accounts, modules):
+            for name in names:
+                func, setup = STAGES[name]
+                results[name].append((accounts, timed(func, lambda: setup() or ())))
+    for name in names:
+        print_scaling(f"{name}, {modules} localizations", 'accounts', results[name])
+
+# memory ----------------------------------------------------
+
+def traced(func):
+    """Memory allocated by `func` and still held by its result, and the peak, in bytes."""
+    tracemalloc.start()
+    try:
+        result = func()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained, peak
+
+def bench_memory(scale=1, modules=2):
+    """Memory taken by the records read from generated localizations of growing sizes."""
+    cache.enabled = False
+    results = []
+    for accounts in (100 * scale, 200 * scale, 400 * scale, 800 * scale):
+        with synthetic_addons(accounts, modules):
+            reset()
+            results.append((accounts, *traced(transform_coa.read_data)))
+    print_memory(f"read_data, {modules} localizations", 'accounts', results)
+
+# -----------------------------------------------------------
+
+BENCHMARKS = {
+    'pformat': bench_pformat,
+    'memory': bench_memory,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the transformation, the stages run on generated localizations.")
+    parser.add_argument('benchmarks', nargs='*', help=f"benchmarks to run among {', '.join([*BENCHMARKS, *STAGES])} (default: all)")
+    parser.add_argument('--scale', type=int, default=1, help="multiply the sizes of the inputs")
+    parser.add_argument('--modules', type=int, default=2, help="number of generated localizations")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS and name not in STAGES:
+            parser.error(f"unknown benchmark {name}")
+    names = args.benchmarks or [*BENCHMARKS, *STAGES]
+    for name in names:
+        if name in BENCHMARKS:
+            BENCHMARKS[name](args.scale, args.modules)
+    stages = [name for name in names if name in STAGES]
+    if stages:
+        bench_stages(stages, args.scale, args.modules)
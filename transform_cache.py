@@ -0,0 +1,161 @@
+# pylint: skip-file
+from collections import OrderedDict
+from hashlib import sha256
+import logging
+import os
+from pathlib import Path
+import pickle
+
+from config import CACHE_PATH, CACHE_SIZE
+from transform_tools import changeset, stats, worker_state
+
+_logger = logging.getLogger(__name__)
+
+
+def _tool_version():
+    digest = sha256()
+    for path in sorted(Path(__file__).parent.glob('*.py')):
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+TOOL_VERSION = _tool_version()
+
+
+class ParseCache():
+    """
+        On-disk cache of parsing results, keyed by the content of the files they come from and by the version
+        of the tool. The least recently used entries are evicted when the cache grows above `max_size` bytes.
+    """
+    def __init__(self, path, max_size):
+        self.path = Path(path).expanduser()
+        self.max_size = max_size
+        self.enabled = True
+        self.memory = None  # key -> pickled entry, kept by long-lived processes, see keep_in_memory
+        self.memory_size = 0
+
+    def _entry(self, key):
+        return self.path / f"{key}.pickle"
+
+    def keep_in_memory(self):
+        """
+            Also keep the entries in this process, for the runs after the first one of a long-lived process.
+            They are kept pickled as the results are modified by the transformation.
+        """
+        if self.memory is None:
+            self.memory = OrderedDict()
+
+    def _remember(self, key, data):
+        if self.memory is None:
+            return
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.max_size:
+            _key, forgotten = self.memory.popitem(last=False)
+            self.memory_size -= len(forgotten)
+
+    def get(self, key):
+        if self.memory is not None and key in self.memory:
+            self.memory.move_to_end(key)
+            return pickle.loads(self.memory[key])
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as file:
+                data = file.read()
+        except OSError:
+            return None
+        try:
+            value = pickle.loads(data)
+        except Exception as e:
+            # Truncated, or written with another layout of the classes: computed again and replaced
+            _logger.debug("Invalid cache entry %s, %s", entry, e)
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            return None
+        os.utime(entry)
+        self._remember(key, data)
+        return value
+
+    def set(self, key, value):
+        entry = self._entry(key)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = entry.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, 'wb') as file:
+            file.write(data)
+        os.replace(tmp, entry)
+        self._remember(key, data)
+
+    def evict(self):
+        if not self.path.is_dir():
+            return
+        entries = []
+        with os.scandir(self.path) as files:
+            for file in files:
+                if file.name.endswith('.pickle'):
+                    stat = file.stat()
+                    entries.append((stat.st_mtime, stat.st_size, file.path))
+        total = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+cache = ParseCache(CACHE_PATH, CACHE_SIZE)
+
+def _restore_cache(enabled):
+    cache.enabled = enabled
+
+worker_state('cache', lambda: cache.enabled, _restore_cache)
+
+
+_digests = {}  # (path, inode, size, mtime) -> hash of the files that are not staged
+
+def file_digest(path):
+    """Hash of the content of a file, as staged in the changeset."""
+    digest = sha256()
+    if os.path.abspath(path) in changeset.changes:
+        digest.update(changeset.read(path, 'rb'))
+        return digest.hexdigest()
+    with open(path, 'rb') as file:
+        stat = os.fstat(file.fileno())
+        key = (os.path.abspath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if key not in _digests:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+            _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+def cached(namespace, key_parts, compute):
+    """
+        Return `compute()`, or its result from a previous run with the same key.
+        The changes staged by `compute` are cached too, and staged again when the result comes from the cache.
+    """
+    if not cache.enabled:
+        return compute()
+    digest = sha256(TOOL_VERSION.encode())
+    for part in (namespace, *key_parts):
+        digest.update(b'\0' + (part if isinstance(part, bytes) else repr(part).encode()))
+    key = digest.hexdigest()
+
+    hit = cache.get(key)
+    if hit is not None:
+        stats[f'cache.{namespace}.hits'] += 1
+        result, journal = hit
+        changeset.replay(journal)
+        return result
+    stats[f'cache.{namespace}.misses'] += 1
+    start = len(changeset.journal)
+    result = compute()
+    cache.set(key, (result, changeset.journal[start:]))
+    return result
+
+def cache_report():
+    namespaces = sorted({key.split('.')[1] for key in stats if key.startswith('cache.')})
+    report = []
+    for namespace in namespaces:
+        hits, misses = stats[f'cache.{namespace}.hits'], stats[f'cache.{namespace}.misses']
+        report.append(f"{namespace}: {hits}/{hits + misses} hits ({100 * hits // (hits + misses)}%)")
+    return ', '.join(report)
@@ -1,25 +1,78 @@
 #!/usr/bin/env python3
 # pylint: skip-file
 
+import argparse
 import ast
 from collections import defaultdict
 from copy import deepcopy
+from functools import lru_cache, partial
 import io
 import logging
-import os
 from pathlib import Path
 import re
+import shlex
+import sys
+import time
 
 from lxml import etree
 import polib
 
-from config import ODOO_PATH
+from config import ODOO_PATH, WRITE_THREADS
 from mapping import chart_mapper
+from transform_cache import cache, cache_report, cached, file_digest
+from transform_profile import profiler
 import transform_models
 from transform_csv import convert_csv_to_records, convert_records_to_csv
-from transform_tools import unquote_ref, Unquoted, indent, pformat, save_new_file, ref_module
+from transform_tools import addons_inventory, changeset, l10n_addons, module_files, select_modules, unquote_ref, Unquoted, indent, pformat, pool_map, save_new_file, ref_module, stats, symbol, worker_pool, write_pformat, xmlids
 
 PYTHON_HEADER = "# Part of Odoo. See LICENSE file for full copyright and licensing details.\n"
+SERVE_DONE = "transform_coa: done"  # printed after each run of --serve, followed by ok or error
+WATCH_INTERVAL = 0.5  # seconds between two scans of the source files in --watch mode
+SOURCE_FILES = ('data_csv', 'data_xml', 'demo_xml', 'po')  # files of module_files read by the transformation
+
+# Models whose records are no longer translated through the PO files of the module
+DEPRECATED_TRANSLATION_MODELS = [
+    'account.account',
+    'account.account.template',
+    'account.group',
+    'account.group.template',
+    'account.tax',
+    'account.tax.template',
+    'account.tax.group',
+    'account.tax.group.template',
+    'account.fiscal.position',
+    'account.fiscal.position.template',
+    'account.chart.template',
+]
+DEPRECATED_OCCURRENCE_RE = re.compile(f"model:(?:{'|'.join(map(re.escape, DEPRECATED_TRANSLATION_MODELS))}),")
+
+# Models of the old CSV files, in the order they are read
+CSV_MODELS = [
+    "account.fiscal.position",
+    "account.fiscal.position.tax",
+    "account.fiscal.position.account",
+    "account.tax",
+    "account.account",
+    "account.group",
+    "account.tax.group",
+    "account.chart.template",
+]
+
+# Records merged into their parent: (child models, field referencing the parent, parent models, one2many field)
+CHILD_LINKS = [
+    (
+        ('account.fiscal.position.tax', 'account.fiscal.position.tax.template'), 'position_id',
+        ('account.fiscal.position', 'account.fiscal.position.template'), 'tax_ids',
+    ),
+    (
+        ('account.fiscal.position.account', 'account.fiscal.position.account.template'), 'position_id',
+        ('account.fiscal.position', 'account.fiscal.position.template'), 'account_ids',
+    ),
+    (
+        ('account.reconcile.model.line', 'account.reconcile.model.line.template'), 'model_id',
+        ('account.reconcile.model', 'account.reconcile.model.template'), 'line_ids',
+    ),
+]
 
 _logger = logging.getLogger(__name__)
 
@@ -29,26 +82,25 @@ env = locals().get('env') or {}
 
 # -----------------------------------------------
 
-def parse_file(filename):
-    module = str(filename).split('/')[-3]
+def parse_file(filename, rewrite=True):
+    module = symbol(str(filename).split('/')[-3])
     if not module.startswith('l10n_'): return {}
-    with open(filename, 'rb') as file:
-        file_read = file.read().split(b'\n')
-        try:
-            root = etree.fromstring(file_read[0] + b'&#xA;'.join(file_read[1:-1]) + file_read[-1])
-            original_root = etree.fromstring(file_read[0] + b'&#xA;'.join(file_read[1:-1]) + file_read[-1])
-        except etree.XMLSyntaxError:
-            root = etree.fromstring(b'\n'.join(file_read))
-            original_root = etree.fromstring(b'\n'.join(file_read))
-
+    file_read = changeset.read(filename, 'rb').split(b'\n')
+    try:
+        root = etree.fromstring(file_read[0] + b'&#xA;'.join(file_read[1:-1]) + file_read[-1])
+    except etree.XMLSyntaxError:
+        root = etree.fromstring(b'\n'.join(file_read))
 
+    # Set whenever the traversal inserts or removes a node, so that we know if the file has to be
+    # rewritten without keeping a pristine copy of the tree around.
+    dirty = False
     nodes_tree = []
     stack = [(nodes_tree, root)]
     parent = nodes_tree
     while stack:
 
         # Pop an element out of the stack
-        parent, el = stack.pop(0)
+        parent, el = stack.pop()
 
         # Create a new node and attach it to the parent
         if el.tag in ('record', 'function'):
@@ -76,6 +128,7 @@ def parse_file(filename):
         {etree.tostring(el.getchildren()[1]).decode().strip()}
     </function>
 """))
+                dirty = True
 
         if (
             el.getparent()
@@ -84,46 +137,59 @@ def parse_file(filename):
             and (node._from.endswith('.template') or node._from == 'account.tax.group')
         ):
             el.getparent().remove(el)
+            dirty = True
 
-        # Populate the stack with the node's children
-        stack = [(node, child) for child in el] + stack
+        # Populate the stack with the node's children, reversed so that they are popped in document order
+        stack.extend((node, child) for child in reversed(el))
 
     is_empty = lambda node: node.tag in ('odoo', 'data') and all(is_empty(sub) or sub.tag == etree.Comment for sub in node)
-    if not is_empty(root):
-        if etree.tostring(original_root) != etree.tostring(root):
-            with open(filename, 'w') as file:
-                file.write('<?xml version="1.0" encoding="utf-8"?>\n' + etree.tostring(
-                    root,
-                    encoding='utf-8',
-                ).decode().replace('&#10;', '\n') + '\n')
-    else:
-        os.remove(filename)
+    if rewrite and not is_empty(root):
+        if dirty:
+            changeset.write(filename, '<?xml version="1.0" encoding="utf-8"?>\n' + etree.tostring(
+                root,
+                encoding='utf-8',
+            ).decode().replace('&#10;', '\n') + '\n')
+    elif rewrite:
+        changeset.delete(filename)
 
     for record in nodes_tree:
         yield record['id'], record
 
-def get_xml_records():
+def parse_cached_file(filename, rewrite=True):
+    """Same as parse_file, as a list, taken from the cache if the file didn't change since a previous run."""
+    key = (str(filename), rewrite, file_digest(filename))
+    return cached('parse_file', key, lambda: list(parse_file(filename, rewrite)))
+
+def _parse_xml_file(filename):
+    """Parse a whole file, so that it can be done in a worker process."""
+    try:
+        return parse_cached_file(filename), None
+    except etree.ParseError as e:
+        return [], str(e)
+
+def get_xml_records(jobs=1, modules=None):
     records = defaultdict(dict)
-    for filename in Path.cwd().glob(f'{ODOO_PATH}/addons/*/data/*.xml'):
-        module = str(filename).split('/')[-3]
-        try:
-            for key, value in parse_file(filename):
-                template = value.get('_template')
-                if value['tag'] == 'function':
-                    continue
-                if key not in records[(module, template)]:
-                    records[(module, template)][key] = value
-                elif 'children' in value:
-                    # if the id is already present, merge the fields
-                    for _id, field in value['children'].items():
-                        records[(module, template)][key]['children'][_id] = field
-        except etree.ParseError as e:
-            _logger.warning("Invalid XML file %s, %s", filename, e)
-    for filename in Path.cwd().glob(f'{ODOO_PATH}/addons/*/demo/*.xml'):
-        try:
-            all(parse_file(filename))
-        except etree.ParseError as e:
-            _logger.warning("Invalid XML file %s, %s", filename, e)
+    inventory = addons_inventory(modules)
+    filenames = [filename for files in inventory.values() for filename in files['data_xml']]
+    for filename, (file_records, error) in zip(filenames, pool_map(_parse_xml_file, filenames, jobs)):
+        module = symbol(str(filename).split('/')[-3])
+        if error:
+            _logger.warning("Invalid XML file %s, %s", filename, error)
+            continue
+        for key, value in file_records:
+            template = value.get('_template')
+            if value['tag'] == 'function':
+                continue
+            if key not in records[(module, template)]:
+                records[(module, template)][key] = value
+            elif 'children' in value:
+                # if the id is already present, merge the fields
+                for _id, field in value['children'].items():
+                    records[(module, template)][key]['children'][_id] = field
+    filenames = [filename for files in inventory.values() for filename in files['demo_xml']]
+    for filename, (_file_records, error) in zip(filenames, pool_map(_parse_xml_file, filenames, jobs)):
+        if error:
+            _logger.warning("Invalid XML file %s, %s", filename, error)
     return records
 
 # -----------------------------------------------------------
@@ -165,13 +231,51 @@ def split_template_from_company(all_records, module):
         all_records['res.company'] = {company_record['id']: company_record}
     return all_records
 
-def cleanup_tax_tags(all_records):
-    tags = {
-        k: v
-        for records in all_records.values()
-        for report in records.get('account.report', {}).values()
-        for k, v in report.get_tags().items()
-    }
+def get_report_tags(module):
+    """Tags of the reports of a module that isn't transformed, its files are left untouched."""
+    tags = {}
+    for filename in module_files(module)['data_xml']:
+        try:
+            for _id, record in parse_cached_file(filename, rewrite=False):
+                if record['_model'] == 'account.report':
+                    record.get_tags(tags)
+        except etree.ParseError as e:
+            _logger.warning("Invalid XML file %s, %s", filename, e)
+    return tags
+
+class ReportTags(dict):
+    """
+        Tags by expression xmlid, the reports of a module are indexed when one of its tags is first needed:
+        the reports read with the records, or the ones of its files if the module isn't loaded.
+    """
+    def __init__(self, reports, loaded_modules):
+        super().__init__()
+        self.reports = reports  # module -> reports read with the records, not indexed yet
+        self.loaded_modules = set(loaded_modules)
+
+    def __missing__(self, key):
+        module = key.split('.')[0]
+        if module in self.reports:
+            for report in self.reports.pop(module):
+                report.get_tags(self)
+        elif self.reports:
+            # The expression can belong to the report of another module
+            for reports in self.reports.values():
+                for report in reports:
+                    report.get_tags(self)
+            self.reports.clear()
+        elif module in self.loaded_modules or module not in l10n_addons():
+            raise KeyError(key)
+        else:
+            self.loaded_modules.add(module)
+            self.update(get_report_tags(module))
+        return self[key]
+
+def cleanup_tax_tags(all_records, modules=None):
+    reports = defaultdict(list)
+    for (module, _template), records in all_records.items():
+        reports[module].extend(records.get('account.report', {}).values())
+    tags = ReportTags(reports, addons_inventory(modules))
     for records in all_records.values():
         taxes = records.get('account.tax', {}).values()
         many_fields = [line for x in taxes for lines in x.get_repartition_lines() for line in lines]
@@ -179,232 +283,420 @@ def cleanup_tax_tags(all_records):
             if len(token) == 3 and token[0] == 0:
                 token[2].cleanup_tags(tags)
 
-def merge_fpos(all_records):
-    all_fpos = {
-        id: fpos
-        for records in all_records.values()
-        for id, fpos in {
-            **records.get('account.fiscal.position', {}),
-            **records.get('account.fiscal.position.template', {}),
-        }.items()
-    }
-    for (module, template), records in all_records.items():
-        for model in ['account.fiscal.position.tax', 'account.fiscal.position.tax.template']:
-            for record in records.pop(model, {}).values():
-                _id = ref_module(str(record['children'].pop('position_id')._original_value), module)
-                if 'tax_ids' not in all_fpos[_id]['children']:
-                    all_fpos[_id].append(transform_models.Field({'id': 'tax_ids', 'eval': '[]'}))
-                all_fpos[_id]['children']['tax_ids']._value.append((0, 0, record))
-        for model in ['account.fiscal.position.account', 'account.fiscal.position.account.template']:
-            for record in records.pop(model, {}).values():
-                _id = ref_module(str(record['children'].pop('position_id')._original_value), module)
-                if 'account_ids' not in all_fpos[_id]['children']:
-                    all_fpos[_id].append(transform_models.Field({'id': 'account_ids', 'eval': '[]'}))
-                all_fpos[_id]['children']['account_ids']._value.append((0, 0, record))
-
-def merge_reco_model(all_records):
-    all_models = {
-        id: model
-        for records in all_records.values()
-        for id, model in {
-            **records.get('account.reconcile.model', {}),
-            **records.get('account.reconcile.model.template', {}),
-        }.items()
-    }
+def link_children(all_records, links=None):
+    """
+        Move the child records into the one2many field of their parent, as (0, 0, record) commands,
+        for each (child models, field referencing the parent, parent models, one2many field) of `links`.
+        The parents of all the buckets are indexed once, and the children whose parent is missing
+        are dropped and reported.
+    """
+    links = CHILD_LINKS if links is None else links
+    parents = {parent_models: {} for _child_models, _field, parent_models, _o2m in links}
+    for records in all_records.values():
+        for parent_models, index in parents.items():
+            for model in parent_models:
+                index.update(records.get(model, {}))
 
+    orphans = []
     for (module, template), records in all_records.items():
-        for model in ['account.reconcile.model.line', 'account.reconcile.model.line.template']:
-            for record in records.pop(model, {}).values():
-                _id = ref_module(str(record['children'].pop('model_id')._original_value), module)
-                if 'line_ids' not in all_models[_id]['children']:
-                    all_models[_id].append(transform_models.Field({'id': 'line_ids', 'eval': '[]'}))
-                all_models[_id]['children']['line_ids']._value.append((0, 0, record))
-
-
-
+        for child_models, field, parent_models, o2m in links:
+            for model in child_models:
+                for record in records.pop(model, {}).values():
+                    parent_ref = record['children'].pop(field, None)
+                    parent = parent_ref and parents[parent_models].get(ref_module(str(parent_ref._original_value), module))
+                    if parent is None:
+                        orphans.append(f"{record['id']} ({field}: {parent_ref and parent_ref._original_value})")
+                        continue
+                    if o2m not in parent.get('children', {}):
+                        parent.append(transform_models.Field({'id': o2m, 'eval': '[]'}))
+                    parent['children'][o2m]._value.append((0, 0, record))
+    if orphans:
+        _logger.warning("%s records dropped, their parent is missing: %s", len(orphans), ', '.join(orphans))
+
+
+@lru_cache(maxsize=None)
 def load_translations(module):
-    paths = Path.cwd().glob(f'{ODOO_PATH}/addons/{module}/i18n*/*.po*')
+    """Translations by msgid and language, loaded once per module and shared by all its templates."""
+    paths = module_files(module)['po']
+    key = (module, *((str(path), file_digest(path)) for path in paths))
+    return cached('load_translations', key, partial(_load_translations, module, paths))
+
+def _load_translations(module, paths):
     translations = defaultdict(dict)
     for path in paths:
-        pofile = polib.pofile(path)
-        original_pofile = polib.pofile(path)
+        pofile = polib.pofile(changeset.read(path))
+        changed = False
         for entry in pofile:
             if entry.msgstr:
                 translations[entry.msgid][path.stem] = entry.msgstr
-            entry.occurrences = [
+            occurrences = [
                 occurrence
                 for occurrence in entry.occurrences
-                if 'model:account.account,' not in occurrence[0]
-                and 'model:account.account.template,' not in occurrence[0]
-                and 'model:account.group,' not in occurrence[0]
-                and 'model:account.group.template,' not in occurrence[0]
-                and 'model:account.tax,' not in occurrence[0]
-                and 'model:account.tax.template,' not in occurrence[0]
-                and 'model:account.tax.group,' not in occurrence[0]
-                and 'model:account.tax.group.template,' not in occurrence[0]
-                and 'model:account.fiscal.position,' not in occurrence[0]
-                and 'model:account.fiscal.position.template,' not in occurrence[0]
-                and 'model:account.chart.template,' not in occurrence[0]
+                if not DEPRECATED_OCCURRENCE_RE.search(occurrence[0])
             ]
+            changed |= len(occurrences) != len(entry.occurrences)
+            entry.occurrences = occurrences
             if not entry.occurrences:
                 entry.obsolete = True
         for entry in pofile.obsolete_entries():
             pofile.remove(entry)
-        if pofile != original_pofile:
-            with open(path, 'w') as file:
-                file.write(str(pofile))
+            changed = True
+        if changed:
+            changeset.write(path, str(pofile))
     return translations
 
-def read_data():
+def collect_records(jobs=1, modules=None):
+    """Records of the CSV and XML files by (module, template) bucket, before they are cleaned up."""
+    def bucket(module, template):
+        if (module, template) not in all_records:
+            bucket_rank[(module, template)] = len(all_records)
+        return all_records[(module, template)]
+
     def merge(module, template, model, id, values):
         id = ref_module(id, module)
         if model.endswith('.template') and model != 'account.chart.template':
-            model = model[:-9]
+            model = symbol(model[:-9])
+        key = (module, model, id)
         if template:
             template = ref_module(str(template), module)
-            if model in all_records[(module, None)] and id in all_records[(module, None)][model]:
-                merge(module, template, model, id, all_records[(module, None)][model].pop(id))
-        else:
-            for m, t in all_records:
-                if m == module and model in all_records[(m, t)] and id in all_records[(m, t)][model]:
-                    template = t
-                    break
-
-        if model not in all_records[(module, template)]:
-            all_records[(module, template)][model] = {}
-        if id not in all_records[(module, template)][model]:
-            all_records[(module, template)][model][id] = values
+            untemplated = bucket(module, None)
+            if None in placement.get(key, ()):
+                placement[key].remove(None)
+                merge(module, template, model, id, untemplated[model].pop(id))
+        elif placement.get(key):
+            # Same bucket as the first one containing the record
+            template = min(placement[key], key=lambda t: bucket_rank[(module, t)])
+
+        records = bucket(module, template).setdefault(model, {})
+        if id not in records:
+            records[id] = values
+            placement[key].append(template)
+            xmlids.add(id, model, module, values)
         else:
-            all_records[(module, template)][model][id]['children'].update(values['children'])
+            records[id]['children'].update(values['children'])
 
+    bucket_rank = {}  # (module, template) -> position of the bucket in all_records
+    placement = defaultdict(list)  # (module, model, id) -> templates of the buckets containing the record
     all_records = defaultdict(dict)
-    for model in [
-        "account.fiscal.position",
-        "account.fiscal.position.tax",
-        "account.fiscal.position.account",
-        "account.tax",
-        "account.account",
-        "account.group",
-        "account.tax.group",
-        "account.chart.template",
-    ]:
-        for (module, template), values in convert_csv_to_records(model).items():
+    xmlids.clear()
+    xmlids.modules.update(addons_inventory(modules))
+    with profiler.phase('read_csv'):
+        for model, csv_records in zip(CSV_MODELS, pool_map(partial(convert_csv_to_records, modules=modules), CSV_MODELS, jobs)):
+            for (module, template), values in csv_records.items():
+                for value in values.values():
+                    merge(module, template, model, value['id'], value)
+                stats['records.read'] += len(values)
+    with profiler.phase('read_xml'):
+        for (module, template), values in get_xml_records(jobs, modules).items():
             for value in values.values():
-                merge(module, template, model, value['id'], value)
-    for (module, template), values in get_xml_records().items():
-        for value in values.values():
-            merge(module, template, value['_model'], value['id'], value)
+                merge(module, template, value['_model'], value['id'], value)
+            stats['records.read'] += len(values)
+    return all_records
 
-    for (module, template), records in all_records.items():
-        split_template_from_company(records, module)
-    cleanup_tax_tags(all_records)
-    merge_fpos(all_records)
-    merge_reco_model(all_records)
+def read_data(jobs=1, modules=None):
+    all_records = collect_records(jobs, modules)
+    with profiler.phase('split_template_from_company'):
+        for (module, template), records in all_records.items():
+            split_template_from_company(records, module)
+    with profiler.phase('cleanup_tax_tags'):
+        cleanup_tax_tags(all_records, modules)
+    with profiler.phase('link_children'):
+        link_children(all_records)
 
     return all_records
 
+def resolve_references(all_records, module_templates):
+    """
+        Once every xmlid is indexed, make the values of the records that are translated plain strings
+        again: the ones of the templates and the tax groups of their modules. They are resolved before
+        the modules are sent to the worker processes, that don't get the index.
+    """
+    for module, old_templates in module_templates.items():
+        buckets = [all_records[(module, old_template)] for old_template in old_templates]
+        buckets.append({'account.tax.group': all_records.get((module, None), {}).get('account.tax.group', {})})
+        for records in buckets:
+            for model_records in records.values():
+                for record in model_records.values():
+                    transform_models.resolve_references(record)
+
+
+def _translate_module(args):
+    """Translate a module from the buckets of its records, so that they are the only ones sent to a worker process."""
+    module, old_templates, module_records = args
+    translate_module(module_records, module, old_templates)
 
-def do_translate():
+def do_translate(jobs=1, modules=None, dry_run=False, use_cache=True, profile=None, profile_stats=None, keep_sources=False, write_threads=WRITE_THREADS):
     """
         Translate an old Chart Template from a module to a new set of files and a Python class.
+        Only the given modules are read and written (all the l10n modules by default).
+        The changes are staged and written at the end, or only shown if `dry_run` is set.
+        Unless `use_cache` is False, the parsed files are kept in a cache for the next runs.
+        If `profile` is set, the timings and counters of each phase are written there as JSON,
+        and the phases are dumped with cProfile in the `profile_stats` directory if it is set.
+        If `keep_sources` is set, the files read by the transformation are left as they are, only the
+        new files are written. The files are written by `write_threads` threads.
     """
-    all_records = read_data()
-    for (module, old_template), records in all_records.items():
-        if old_template is None:
-            continue
-        if not old_template:
-            print('missing template on', [key for records in records.values() for key in records.keys()])
-            continue
-        assert 'account.tax.group' not in records
-        records['account.tax.group'] = all_records.get((module, None), {}).get('account.tax.group', {})
-        template = chart_mapper(old_template)
+    cache.enabled = use_cache
+    if profile:
+        profiler.start(profile_stats)
+    sources = [path for files in addons_inventory(modules).values() for kind in SOURCE_FILES for path in files[kind]]
+    with worker_pool(jobs):
+        all_records = read_data(jobs, modules)
+        if keep_sources:
+            # Before the manifests are cleaned up, so that they keep the data files left in place
+            changeset.discard(sources)
+        module_templates = defaultdict(list)
+        module_records = defaultdict(dict)
+        for (module, old_template), records in all_records.items():
+            module_records[module][(module, old_template)] = records
+            if old_template is None:
+                continue
+            if not old_template:
+                print('missing template on', [key for records in records.values() for key in records.keys()])
+                continue
+            module_templates[module].append(old_template)
+        with profiler.phase('resolve_references'):
+            resolve_references(all_records, module_templates)
+        unknown = xmlids.take_unknown()
+        if unknown:
+            _logger.warning(
+                "%s unknown references, written as they are: %s",
+                len(unknown),
+                ', '.join(f"{xmlid} (in {', '.join(sorted(unknown[xmlid]))})" for xmlid in sorted(unknown)),
+            )
+
+        # Modules don't share anything once the records are read, but the templates of a module do
+        # (i.e. the tax groups), so a module is the unit of work.
+        tasks = [(module, old_templates, module_records[module]) for module, old_templates in module_templates.items()]
+        list(pool_map(_translate_module, tasks, jobs))
+    _logger.info(
+        "eval attributes: %(literal)s literals, %(hits)s cache hits, %(misses)s cache misses",
+        transform_models.eval_cache_info(),
+    )
+    if cache.enabled:
+        _logger.info("parse cache: %s", cache_report())
+
+    if keep_sources:
+        # The PO files cleaned up with the translations
+        changeset.discard(sources)
+    # Nothing is written before everything succeeded
+    with profiler.phase('write'):
+        if dry_run:
+            print(changeset.diff())
+            print(changeset.summary())
+        else:
+            changeset.apply(write_threads)
+    if cache.enabled:
+        cache.evict()
+    if profile:
+        profiler.write_report(
+            profile,
+            jobs=jobs,
+            modules=modules,
+            dry_run=dry_run,
+            eval=transform_models.eval_cache_info(),
+        )
+
+def forget_tree():
+    """Forget what was read from the addons and staged, before running again on a tree that changed."""
+    l10n_addons.cache_clear()
+    module_files.cache_clear()
+    load_translations.cache_clear()
+    changeset.discard()
+    stats.clear()
+
+def serve(jobs=1, use_cache=True, write_threads=WRITE_THREADS):
+    """
+        Transform the modules given on each line of the standard input, with the same syntax as the
+        command line, in this process. The parsed files are kept in memory between the runs, and the
+        cache is keyed by their content, so only the files that changed since the previous line are
+        parsed again. Each run ends with a `SERVE_DONE ok` or `SERVE_DONE error` line.
+    """
+    cache.keep_in_memory()
+    for line in sys.stdin:
+        forget_tree()
+        try:
+            do_translate(jobs=jobs, modules=select_modules(shlex.split(line)), use_cache=use_cache, write_threads=write_threads)
+        except Exception:
+            _logger.exception("Transformation of %s failed", line.strip() or "all the modules")
+            changeset.discard()
+            status = 'error'
+        else:
+            status = 'ok'
+        print(SERVE_DONE, status, flush=True)
+
+def source_snapshot(modules=None):
+    """(mtime, size) of the files read by the transformation, by path and module."""
+    snapshot = {}
+    for module, files in addons_inventory(modules).items():
+        snapshot[module] = {}
+        for path in (path for kind in SOURCE_FILES for path in files[kind]):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[module][path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+def dependent_modules(modules):
+    """The given l10n modules and the ones depending on them, directly or not, according to their manifests."""
+    depends = {}
+    for module, files in addons_inventory().items():
+        try:
+            depends[module] = set(eval(changeset.read(files['manifest'])).get('depends', ())) if files['manifest'] else set()
+        except Exception:
+            _logger.warning("Invalid manifest %s, its dependencies are ignored", files['manifest'])
+            depends[module] = set()
+    dependents = set(modules)
+    added = dependents
+    while added:
+        added = {module for module, module_depends in depends.items() if module not in dependents and module_depends & added}
+        dependents |= added
+    return dependents
+
+def watch_step(snapshot, jobs=1, modules=None, dry_run=False, use_cache=True, write_threads=WRITE_THREADS):
+    """
+        Transform the modules whose source files were modified, added or removed since `snapshot`
+        (all of them if it is empty), along with the modules depending on them, leaving the source
+        files as they are. Return the snapshot of the source files taken before the transformation.
+    """
+    forget_tree()
+    current = source_snapshot(modules)
+    changed = [module for module, files in current.items() if files != snapshot.get(module)]
+    if changed:
+        dependents = dependent_modules(changed)
+        changed = [module for module in current if module in dependents]
+        _logger.info("transforming %s", ', '.join(changed))
+        start = time.perf_counter()
+        try:
+            do_translate(jobs=jobs, modules=changed, dry_run=dry_run, use_cache=use_cache, keep_sources=True, write_threads=write_threads)
+        except Exception:
+            _logger.exception("Transformation of %s failed", ', '.join(changed))
+            changeset.discard()
+        else:
+            _logger.info("done in %.2fs, watching the source files", time.perf_counter() - start)
+    return current
+
+def watch(jobs=1, modules=None, dry_run=False, use_cache=True, write_threads=WRITE_THREADS):
+    """
+        Transform the modules, then scan their source files every WATCH_INTERVAL seconds and transform
+        again the modules whose files changed, see watch_step. The source files are left as they are so
+        that they can be edited between the runs, and the parsed files are kept in memory: only the
+        modified ones are parsed again.
+    """
+    cache.keep_in_memory()
+    snapshot = {}
+    try:
+        while True:
+            snapshot = watch_step(snapshot, jobs, modules, dry_run, use_cache, write_threads)
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+
+def translate_module(all_records, module, old_templates):
+    with profiler.phase(f'translate:{module}'):
+        for old_template in old_templates:
+            stats['records.translated'] += sum(len(records) for records in all_records[(module, old_template)].values())
+            translate_template(all_records, module, old_template)
+
+
+def translate_template(all_records, module, old_template):
+    """Write the new files of one template of a module."""
+    records = all_records[(module, old_template)]
+    assert 'account.tax.group' not in records
+    records['account.tax.group'] = all_records.get((module, None), {}).get('account.tax.group', {})
+    template = chart_mapper(old_template)
+    with profiler.phase('load_translations'):
         translations = load_translations(module)
 
-        for model in ['account.account', 'account.group', 'account.tax.group', 'account.tax', 'account.fiscal.position', 'account.reconcile.model']:
-            if model in records:
-                for record in records[model].values():
-                    if record['children'] and record['children']['name']._value in translations:
-                        for lang, translated in translations[record['children']['name']._value].items():
-                            lang_field = f"name@{lang}"
-                            record['children'][lang_field] = transform_models.Field({
-                                'id': lang_field,
-                                'text': translated,
-                            })
-
-        # Move tax group properties on the tax group
-        for tax_group in records['account.tax.group'].values():
-            for field in [
-                'property_tax_receivable_account_id',
-                'property_tax_payable_account_id',
-                'property_advance_tax_payment_account_id',
-            ]:
-                if field in tax_group['children']:
-                    new_name = field[9:]
-                    tax_group['children'][new_name] = tax_group['children'].pop(field)
-
-        for chart in records['account.chart.template'].values():
-            for field in [
-                'property_tax_receivable_account_id',
-                'property_tax_payable_account_id',
-                'property_advance_tax_payment_account_id',
-            ]:
-                if field in chart['children']:
-                    new_name = field[9:]
-                    value = chart['children'][field]._value
-                    for tax_group in records['account.tax.group'].values():
-                        if new_name not in tax_group['children']:
-                            tax_group['children'][new_name] = transform_models.Field({
-                                'id': new_name,
-                                'ref': value,
-                            })
-                    del chart['children'][field]
-
-        # CSV files
-        for model in ['account.account', 'account.group', 'account.tax.group', 'account.tax', 'account.fiscal.position']:
+    for model in ['account.account', 'account.group', 'account.tax.group', 'account.tax', 'account.fiscal.position', 'account.reconcile.model']:
+        if model in records:
+            for record in records[model].values():
+                if record['children'] and record['children']['name']._value in translations:
+                    for lang, translated in translations[record['children']['name']._value].items():
+                        lang_field = f"name@{lang}"
+                        record['children'][lang_field] = transform_models.Field({
+                            'id': lang_field,
+                            'text': translated,
+                        })
+
+    # Move tax group properties on the tax group
+    for tax_group in records['account.tax.group'].values():
+        for field in [
+            'property_tax_receivable_account_id',
+            'property_tax_payable_account_id',
+            'property_advance_tax_payment_account_id',
+        ]:
+            if field in tax_group['children']:
+                new_name = field[9:]
+                tax_group['children'][new_name] = tax_group['children'].pop(field)
+
+    for chart in records['account.chart.template'].values():
+        for field in [
+            'property_tax_receivable_account_id',
+            'property_tax_payable_account_id',
+            'property_advance_tax_payment_account_id',
+        ]:
+            if field in chart['children']:
+                new_name = field[9:]
+                value = chart['children'][field]._value
+                for tax_group in records['account.tax.group'].values():
+                    if new_name not in tax_group['children']:
+                        tax_group['children'][new_name] = transform_models.Field({
+                            'id': new_name,
+                            'ref': value,
+                        })
+                del chart['children'][field]
+
+    # CSV files
+    for model in ['account.account', 'account.group', 'account.tax.group', 'account.tax', 'account.fiscal.position']:
+        with profiler.phase('convert_records_to_csv'):
             content = convert_records_to_csv(records, model)
-            if content:
-                save_new_file(f"{ODOO_PATH}/addons/{module}/data/template/", f"{model}-{template}.csv", content)
-
-        # XML files
-        contents = {}
-        mapping = {
-            "account.chart.template":           f"_get_{template}_template_data",
-            "res.company":                      f"_get_{template}_res_company",
-            "account.reconcile.model":          f"_get_{template}_reconcile_model",
-            "account.reconcile.model.line":     f"_get_{template}_reconcile_model_line",
-            "account.fiscal.position.tax":      f"_get_{template}_fiscal_position_tax",
-            "account.fiscal.position.account":  f"_get_{template}_fiscal_position_account",
-        }
-        for model, function_name in mapping.items():
-            for model_name in (model, model + '.template'):
-                one_level = model_name == 'account.chart.template'
+        if content:
+            save_new_file(f"{ODOO_PATH}/addons/{module}/data/template/", f"{model}-{template}.csv", content)
+
+    # XML files
+    contents = {}
+    mapping = {
+        "account.chart.template":           f"_get_{template}_template_data",
+        "res.company":                      f"_get_{template}_res_company",
+        "account.reconcile.model":          f"_get_{template}_reconcile_model",
+        "account.reconcile.model.line":     f"_get_{template}_reconcile_model_line",
+        "account.fiscal.position.tax":      f"_get_{template}_fiscal_position_tax",
+        "account.fiscal.position.account":  f"_get_{template}_fiscal_position_account",
+    }
+    for model, function_name in mapping.items():
+        for model_name in (model, model + '.template'):
+            one_level = model_name == 'account.chart.template'
+            with profiler.phase('convert_records_to_function'):
                 content = convert_records_to_function(
                     records,
                     model_name,
                     function_name,
                     template,
                     one_level=one_level)
-                if content:
-                    contents[function_name] = contents.get(function_name, "") + content
+            if content:
+                contents[function_name] = contents.get(function_name, "") + content
 
-        content = ""
-        if contents:
-            content += "\n".join(contents.values())
+    content = ""
+    if contents:
+        content += "\n".join(contents.values())
 
-        content = PYTHON_HEADER + (
-            f"from odoo import models{', Command' if 'Command.' in content else ''}\n"
-            "from odoo.addons.account.models.chart_template import template\n"
-            "\n\n"
-            "class AccountChartTemplate(models.AbstractModel):\n"
-            "    _inherit = 'account.chart.template'\n\n"
-        ) + content
+    content = PYTHON_HEADER + (
+        f"from odoo import models{', Command' if 'Command.' in content else ''}\n"
+        "from odoo.addons.account.models.chart_template import template\n"
+        "\n\n"
+        "class AccountChartTemplate(models.AbstractModel):\n"
+        "    _inherit = 'account.chart.template'\n\n"
+    ) + content
 
-        template_module_name = f"template_{template}"
-        save_new_file(f"{ODOO_PATH}/addons/{module}/models/", f"{template_module_name}.py", content)
-        ensure_import(f'{ODOO_PATH}/addons/{module}/__init__.py', 'models')
-        ensure_import(f'{ODOO_PATH}/addons/{module}/models/__init__.py', template_module_name)
+    template_module_name = f"template_{template}"
+    save_new_file(f"{ODOO_PATH}/addons/{module}/models/", f"{template_module_name}.py", content)
+    ensure_import(f'{ODOO_PATH}/addons/{module}/__init__.py', 'models')
+    ensure_import(f'{ODOO_PATH}/addons/{module}/models/__init__.py', template_module_name)
 
-        cleanup_manifest(module)
+    cleanup_manifest(module)
 
 
 def convert_records_to_function(all_records, model, function_name, template, one_level=False):
@@ -414,10 +706,14 @@ def convert_records_to_function(all_records, model, function_name, template, one
         return ''
 
     stream = io.StringIO()
+    stream.write(
+        indent(1, f"@template('{template}', '{model}')\n" if model != 'account.chart.template' else f"@template('{template}')\n")
+        + indent(1, f"def {function_name}(self):\n")
+        + indent(2, "return ")
+    )
     if one_level:
-        record = None
         records.pop('try_loading', None)
-        stream.write(pformat(list(records.items())[0][1], level=2).lstrip())
+        write_pformat(stream, list(records.items())[0][1], level=2, lstrip=True)
     else:
         stream.write("{\n")
         for record in records.values():
@@ -425,29 +721,19 @@ def convert_records_to_function(all_records, model, function_name, template, one
                 key = Unquoted(f"'{record['id'].replace('.', '_')}'")
             else:
                 key = record['id']
-            value = pformat(record, level=3).strip()
-            stream.write(indent(3, f"{key}: {value},\n"))
+            stream.write(indent(3, f"{key}: "))
+            write_pformat(stream, record, level=3, strip=True)
+            stream.write(",\n")
         stream.write(indent(2, "}\n"))
-    body = stream.getvalue()
-
-    stream = io.StringIO()
-    stream.write(
-        indent(1, f"@template('{template}', '{model}')\n" if model != 'account.chart.template' else f"@template('{template}')\n")
-        + indent(1, f"def {function_name}(self):\n")
-        + indent(2, "return ")
-        + body
-    )
     return stream.getvalue()
 
 
 def ensure_import(path: str, import_name: str):
     path = Path.cwd() / path
-    if not path.exists():
-        with open(path, 'w', encoding="utf-8") as init_file:
-            init_file.write(PYTHON_HEADER + f"from . import {import_name}\n")
-            return
-    with open(path, encoding="utf-8") as init_file:
-        init_tree = ast.parse(init_file.read())
+    if not changeset.exists(path):
+        changeset.write(path, PYTHON_HEADER + f"from . import {import_name}\n")
+        return
+    init_tree = ast.parse(changeset.read(path))
     import_idx = next((i for i, n in enumerate(init_tree.body) if isinstance(n, ast.ImportFrom)), 0)
     try:
         next(i for i, n in enumerate(init_tree.body) if isinstance(n, ast.ImportFrom) and n.names[0].name == import_name)
@@ -456,20 +742,18 @@ def ensure_import(path: str, import_name: str):
         pass
     if import_idx != -1:
         init_tree.body.insert(import_idx, ast.ImportFrom('.', [ast.alias(name=import_name)]))
-        with open(path, 'w', encoding="utf-8") as init_file:
-            init_file.write(PYTHON_HEADER + ast.unparse(init_tree) + '\n')
+        changeset.write(path, PYTHON_HEADER + ast.unparse(init_tree) + '\n')
 
 def cleanup_manifest(module):
-    manifest_path = Path.cwd() / f'{ODOO_PATH}/addons/{module}/__manifest__.py'
-    if not manifest_path.exists():
+    manifest_path = module_files(module)['manifest']
+    if not manifest_path:
         return
-    with open(manifest_path, 'r') as manifest:
-        vals = eval(manifest.read())
-        original_vals = deepcopy(vals)
+    vals = eval(changeset.read(manifest_path))
+    original_vals = deepcopy(vals)
     if 'data' in vals:
         for value in list(vals['data']):
             data_path = Path.cwd() / f'{ODOO_PATH}/addons/{module}/{value}'
-            if not data_path.exists():
+            if not changeset.exists(data_path):
                 vals['data'].remove(value)
         if not vals['data']:
             del vals['data']
@@ -478,10 +762,54 @@ def cleanup_manifest(module):
         if 'account' not in vals['depends']:
             vals['depends'].append('account')
     if original_vals != vals:
-        with open(manifest_path, 'w') as manifest:
-            manifest.write(PYTHON_HEADER + pformat(vals))
+        changeset.write(manifest_path, PYTHON_HEADER + pformat(vals))
 
 # -----------------------------------------------------------
 
 if __name__ == '__main__':
-    do_translate()
+    parser = argparse.ArgumentParser(description="Convert the old chart templates of the l10n modules.")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="number of worker processes used to parse and write the modules")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="show the changes instead of writing them")
+    parser.add_argument('--write-threads', type=int, default=WRITE_THREADS, help=f"number of threads writing the changed files at the end of the run (default: {WRITE_THREADS})")
+    parser.add_argument('--no-cache', action='store_true', help="don't read nor fill the cache of the parsed files")
+    parser.add_argument('--profile', metavar='REPORT', help="write the timings and counters of each phase to this JSON file")
+    parser.add_argument('--profile-stats', metavar='DIR', help="with --profile, dump each phase with cProfile in this directory")
+    parser.add_argument('--serve', action='store_true', help="transform the modules given on each line of the standard input, keeping the caches warm between the lines")
+    parser.add_argument('--watch', action='store_true', help="transform the modules again whenever their source files change, the source files are left untouched")
+    parser.add_argument('modules', nargs='*', help="l10n modules to transform: names, globs or addon paths (default: all)")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    if args.profile_stats and not args.profile:
+        parser.error("--profile-stats requires --profile")
+    if args.write_threads < 1:
+        parser.error("--write-threads must be at least 1")
+    try:
+        modules = select_modules(args.modules)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.serve and args.watch:
+        parser.error("--serve and --watch are exclusive")
+    if args.serve:
+        if args.modules or args.dry_run or args.profile:
+            parser.error("--serve reads the modules from the standard input, and can't be combined with --dry-run nor --profile")
+        serve(jobs=args.jobs, use_cache=not args.no_cache, write_threads=args.write_threads)
+    elif args.watch:
+        if args.profile:
+            parser.error("--watch can't be combined with --profile")
+        watch(
+            jobs=args.jobs,
+            modules=modules,
+            dry_run=args.dry_run,
+            use_cache=not args.no_cache,
+            write_threads=args.write_threads,
+        )
+    else:
+        do_translate(
+            jobs=args.jobs,
+            modules=modules,
+            dry_run=args.dry_run,
+            use_cache=not args.no_cache,
+            write_threads=args.write_threads,
+            profile=args.profile,
+            profile_stats=args.profile_stats,
+        )
@@ -1,17 +1,19 @@
 # pylint: skip-file
 import csv
 from collections import defaultdict
+from fnmatch import fnmatchcase
+from functools import partial
+import io
 import os
-from pathlib import Path
 import re
 
-from config import ODOO_PATH
-from transform_tools import Field, Ref, unquote_ref
+from transform_cache import cached, file_digest
+from transform_tools import addons_inventory, changeset, Field, Ref, stats, symbol, unquote_ref
 from transform_models import Record
 
 
 
-def load_old_csv(model):
+def load_old_csv(model, modules=None):
     """
         Look for old Chart Template file and read it.
     """
@@ -21,53 +23,37 @@ def load_old_csv(model):
         f"{model}_template",
         f"{model}_template".replace('_', '.'),
     )
+    inventory = addons_inventory(modules)
     for name in filenames:
-        paths = (
-            list(Path.cwd().glob(f'{ODOO_PATH}/addons/*/data/{name}.csv'))
-            + list(Path.cwd().glob(f'{ODOO_PATH}/addons/*/data/{name}-*.csv'))
-        )
-        for path in paths:
-            module = str(path).split('/')[-3]
-            if not module.startswith('l10n_'): continue
-            with open(path, newline='', encoding='utf-8') as csvfile:
-                yield module, csvfile
-            os.remove(path)
-
-def read_csv_lines(model):
-    for module, csvfile in load_old_csv(model):
-        csvcontent = (csvfile and csvfile.read() or '').split('\n')
-        if not csvcontent:
-            continue
-        reader = csv.reader(csvcontent, delimiter=',')
-        yield module, [line for line in reader if line]
-
-def cleanup_csv(header, rows):
-    for i, column in enumerate(header):
-        header[i] = '"' + str(column).replace('"', '""') + '"'
-    for i, row in enumerate(rows):
-        for j, value in enumerate(row):
-            if value in ('TRUE', 'FALSE'):
-                value = {'TRUE': True, 'FALSE': False}.get(value)
-            if value is None:
-                value = ""
-            rows[i][j] = '"' + str(value).replace('"', '""') + '"'
-    return header, rows
-
-def extract_template_column(header, rows, fields, remove=True):
+        for pattern in (f"{name}.csv", f"{name}-*.csv"):
+            for module, files in inventory.items():
+                for path in [path for path in files['data_csv'] if fnmatchcase(path.name, pattern)]:
+                    files['data_csv'].remove(path)
+                    with open(path, newline='', encoding='utf-8') as csvfile:
+                        stats['files.read'] += 1
+                        stats['bytes.read'] += os.fstat(csvfile.fileno()).st_size
+                        yield module, csvfile
+                    changeset.delete(path)
+
+_REF_RE = re.compile(r'^ref\(.*\)$', re.I)
+
+def read_csv_lines(csvfile):
+    """
+        Iterate over the non-empty lines of a CSV file, read incrementally.
+    """
+    return (line for line in csv.reader(csvfile or (), delimiter=',') if line)
+
+def template_column(header, fields):
+    """
+        Strip the `:id`/`/id` suffixes of the header and find the index of the column holding the template.
+    """
     column = None
-    templates = []
     for i, field in enumerate(header):
         if field in fields:
             column = i
         elif field.endswith(':id') or field.endswith('/id'):
             header[i] = header[i][:-3]
-    if column is not None:
-        getattr(header, 'pop' if remove else '__getitem__')(column)
-        for row in rows:
-            templates.append(getattr(row, 'pop' if remove else '__getitem__')(column))
-    else:
-        templates = [None] * len(rows)
-    return header, rows, templates
+    return header, column
 
 def convert_records_to_csv(records, model):
     def hierarchy(records, path=(), root=None):
@@ -79,11 +65,11 @@ def convert_records_to_csv(records, model):
             for _id, values in record.get('children', {}).items():
                 fname = _id.replace(":", "/")
                 if(
-                    isinstance(values, dict)
+                    isinstance(values, Field)
                     and isinstance(values._value, (list, tuple))
                     and isinstance(values._value[0], (list, tuple))
                     and len(values._value[0]) > 2
-                    and isinstance(values._value[0][2], dict)
+                    and isinstance(values._value[0][2], (dict, Record))
                 ):
                     hierarchy([r[2] for r in record.get('children')[fname]._value], path + (fname,), root)
                 else:
@@ -118,74 +104,113 @@ def convert_records_to_csv(records, model):
     if 'id' not in header:
         header.insert(0, "id")
 
-    rows = []
+    # Compile the columns once: the sub-record path a column belongs to and the field it reads
+    columns = [('/'.join(field.split('/')[:-1]), field.split('/')[-1], field) for field in header]
+
+    stream = io.StringIO()
+    writer = csv.writer(stream, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    writer.writerow(header)
+    empty = True
     for record in records.values():
         children = record.get('children', {})
         for i, line in enumerate(line_getter(header_hierarchy, record) or [[('root', 0)]]):
-            row = []
-            for field in header:
-                if '/'.join(field.split('/')[:-1]) == '/'.join(p[0] for p in line):
-                    sub_rec = record
-                    for el, j in line:
-                        if el not in sub_rec.get('children', {}):
-                            v = ''
-                            break
-                        sub_rec = sub_rec.get('children')[el]._value[j][2]
-                    else:
-                        v = sub_rec.get('children', {}).get(field.split('/')[-1], '')
-                        v = v and v._value
-                    if isinstance(v, list):
-                        v = ','.join(
-                            id_elem
-                            for id_group in ((
-                                [_id] if command == 4
-                                else value[0] if command == 6
-                                else 'UNSUPPORTED COMMAND'
-                            ) for command, _id, *value in v)
-                            for id_elem in id_group
-                        )
-                    row.append(v)
-                elif i != 0:
-                    row.append('')
-                elif field == 'id':
-                    row.append(unquote_ref(record['id']))
-                elif field not in children:
-                    row.append('')
-                elif isinstance(children[field]._value, list):
-                    row.append(','.join(
+            line_path = '/'.join(p[0] for p in line)
+            sub_children = sub_record_children(record, line)
+            writer.writerow([
+                csv_value(
+                    sub_cell(sub_children, fname) if path == line_path
+                    else '' if i != 0
+                    else unquote_ref(record['id']) if field == 'id'
+                    else '' if field not in children
+                    else ','.join(
                         str(s)[1:-1] if str(s).startswith("'") else str(s)
                         for s in children[field]._value[0][2]
-                    ))
-                else:
-                    row.append(children[field]._value)
-            rows.append(row)
+                    ) if isinstance(children[field]._value, list)
+                    else children[field]._value
+                )
+                for path, fname, field in columns
+            ])
+            empty = False
 
-    header, rows = cleanup_csv(header, rows)
-    if not header or not rows:
+    if empty:
         return None
-    return ('\n'.join(','.join([str(field) for field in row]) for row in [header] + rows)).strip() + '\n'
+    return stream.getvalue()
 
-def convert_csv_to_records(model):
+def sub_record_children(record, line):
+    """
+        Children of the sub-record a line of the CSV describes, None if it doesn't exist.
+    """
+    sub_rec = record
+    for el, j in line:
+        if el not in sub_rec.get('children', {}):
+            return None
+        sub_rec = sub_rec.get('children')[el]._value[j][2]
+    return sub_rec.get('children', {})
+
+def sub_cell(sub_children, fname):
+    if sub_children is None:
+        return ''
+    v = sub_children.get(fname, '')
+    v = v and v._value
+    if isinstance(v, list):
+        v = ','.join(
+            str(id_elem)
+            for id_group in ((
+                [_id] if command == 4
+                else value[0] if command == 6
+                else 'UNSUPPORTED COMMAND'
+            ) for command, _id, *value in v)
+            for id_elem in id_group
+        )
+    return v
+
+def csv_value(value):
+    if value in ('TRUE', 'FALSE'):
+        return value == 'TRUE'
+    if value is None:
+        return ""
+    return value
+
+def csv_to_records(model, module, csvfile):
+    """Convert one old CSV file to a list of ((module, template), xmlid, Record)."""
+    records = []
+    lines = read_csv_lines(csvfile)
+    header = next(lines, None)
+    if header is None:
+        return records
+    keep_template = model == 'account.chart.template'
+    header, column = template_column(header, ('id',) if keep_template else ('chart_template_id/id', 'chart_template_id:id'))
+    if column is not None and not keep_template:
+        header.pop(column)
+    header = [symbol(field_header) for field_header in header]
+    id_idx = header.index('id')
+    for row in lines:
+        if column is None:
+            template = None
+        elif keep_template:
+            template = row[column]
+        else:
+            template = row.pop(column)
+        _id = symbol(row[id_idx])
+        record = Record({'id': _id, 'tag': 'record', 'model': model}, 'record', module)
+        for field_header, value in zip(header, row):
+            is_ref = _REF_RE.match(value)
+            record.append(Field({
+                'id': field_header,
+                'text': value if not is_ref else '',
+                'ref': Ref(value) if is_ref else ''
+            }))
+        records.append(((module, template), _id, record))
+    return records
+
+def convert_csv_to_records(model, modules=None):
     """
         Convert old CSV to Records, so that it can be further be processed.
         For example, it can be turned into a Python list.
     """
     records = defaultdict(dict)
-    for module, lines in read_csv_lines(model):
-        header, *rows = lines
-        if model == 'account.chart.template':
-            header, rows, templates = extract_template_column(header, rows, ('id',), remove=False)
-        else:
-            header, rows, templates = extract_template_column(header, rows, ('chart_template_id/id', 'chart_template_id:id'))
-        id_idx = header.index('id')
-        for i, (row, template) in enumerate(zip(rows, templates)):
-            _id = row[id_idx]
-            records[(module, template)][_id] = Record({'id': _id, 'tag': 'record', 'model': model}, 'record', module)
-            for i, field_header in enumerate(header[:len(row)]):
-                is_ref = re.match(r'^ref\(.*\)$', row[i], re.I)
-                records[(module, template)][_id].append(Field({
-                    'id': field_header,
-                    'text': row[i] if not is_ref else '',
-                    'ref': Ref(row[i]) if is_ref else ''
-                }))
+    for module, csvfile in load_old_csv(model, modules):
+        key = (model, module, csvfile.name, file_digest(csvfile.name))
+        for bucket, _id, record in cached('convert_csv_to_records', key, partial(csv_to_records, model, module, csvfile)):
+            records[bucket][_id] = record
     return records
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # pylint: skip-file
 
+from collections.abc import MutableMapping
+from functools import lru_cache
 import re
 import sys
 
@@ -11,13 +13,148 @@ from odoo import Command
 from odoo.tools.safe_eval import safe_eval
 from mapping import chart_mapper
 
-if sys.version_info >= (3, 11):
-    from odoo.tools.safe_eval import _SAFE_OPCODES, to_opcodes
+try:
+    # Private helpers of safe_eval, only used to compile each expression once. Without them,
+    # the expressions are evaluated with the public safe_eval, that compiles them every time.
+    from odoo.tools.safe_eval import _BUILTINS, _SAFE_OPCODES, test_expr
+except ImportError:
+    _BUILTINS = _SAFE_OPCODES = test_expr = None
+
+if sys.version_info >= (3, 11) and _SAFE_OPCODES is not None:
+    from odoo.tools.safe_eval import to_opcodes
     _SAFE_OPCODES.update(to_opcodes(['CALL', 'PUSH_NULL', 'PRECALL', 'RESUME', 'BINARY_OP', 'KW_NAMES']))
 
-class Node(dict):
+# Evaluation of the `eval` attributes -------------------
+
+_LITERALS = {'True': True, 'False': False, 'None': None}
+_NUMBER_RE = re.compile(r'-?(0|[1-9]\d*)(\.\d+)?')
+
+@lru_cache(maxsize=8192)
+def compile_eval(expr):
+    """Validate `expr` the same way as safe_eval does and return the compiled code."""
+    stats['eval.misses'] += 1
+    return test_expr(expr, _SAFE_OPCODES, mode='eval')
+
+def eval_literal(expr):
+    """Return `(True, value)` if `expr` is a trivial literal that doesn't need to be evaluated."""
+    if expr in _LITERALS:
+        return True, _LITERALS[expr]
+    if _NUMBER_RE.fullmatch(expr):
+        return True, float(expr) if '.' in expr else int(expr)
+    if len(expr) > 1 and expr[0] == expr[-1] and expr[0] in '\'"' and expr[0] not in expr[1:-1] and '\\' not in expr:
+        return True, expr[1:-1]
+    return False, None
+
+def field_eval(expr):
+    """Equivalent of `safe_eval(expr)` with the globals of the data files, using the cache."""
+    is_literal, value = eval_literal(expr)
+    if is_literal:
+        stats['eval.literal'] += 1
+        return value
+    stats['eval.lookups'] += 1
+    if test_expr is None:
+        stats['eval.misses'] += 1
+        return safe_eval(expr, globals_dict={'ref': Ref, 'Command': Command})
+    globals_dict = {'__builtins__': dict(_BUILTINS), 'ref': Ref, 'Command': Command}
+    return eval(compile_eval(expr), globals_dict)
+
+def eval_cache_info():
+    """The counters of the evaluations, in `stats` so that the ones of the worker processes are included."""
+    misses = stats['eval.misses']
+    return {'literal': stats['eval.literal'], 'hits': stats['eval.lookups'] - misses, 'misses': misses}
+
+
+def resolve_references(value):
+    """
+        `value` with its XmlidRefs replaced by the xmlids they resolve to, as strings.
+        The records and lists are updated in place, the tuples are rebuilt.
+    """
+    if isinstance(value, XmlidRefs):
+        return str(value)
+    if isinstance(value, Record):
+        children = value.get('children') or {}
+        for child in children.values() if isinstance(children, dict) else children:
+            if isinstance(child, Field):
+                child._value = resolve_references(child._value)
+    elif isinstance(value, list):
+        value[:] = [resolve_references(item) for item in value]
+    elif isinstance(value, tuple):
+        return tuple(resolve_references(item) for item in value)
+    return value
+
+
+class Node(MutableMapping):
+    """
+        Mapping of the keys of a node of the data files, like `node['children']`.
+        The keys of `_keys` are stored in the slots of the same name, as there are millions of nodes,
+        and the other ones in the `_extra` dict, created when needed.
+    """
+    __slots__ = ('id', 'children', '_extra')
+    _keys = ('id', 'children')
+
     def __init__(self, el):
-        super().__init__({'id': el.get('id', el.get('name'))})
+        self._extra = None
+        self.id = symbol(el.get('id', el.get('name')))
+
+    def __setstate__(self, state):
+        # The nodes sent by the worker processes or read from the cache share the identifiers again
+        _dict, slots = state
+        for key, value in slots.items():
+            setattr(self, key, symbol(value) if key in self._keys else value)
+        if isinstance(slots.get('children'), dict):
+            self.children = {symbol(key): child for key, child in slots['children'].items()}
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._keys:
+            setattr(self, key, value)
+        elif self._extra is None:
+            self._extra = {key: value}
+        else:
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._keys:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in self._keys:
+            if hasattr(self, key):
+                yield key
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _key in self)
+
+    def __contains__(self, key):
+        if key in self._keys:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        if key in self._keys:
+            return getattr(self, key, default)
+        return default if self._extra is None else self._extra.get(key, default)
+
+    def __repr__(self):
+        return repr(dict(self))
 
     def append(self, child):
         children = self.get('children') or []
@@ -25,6 +162,8 @@ class Node(dict):
         self['children'] = children
 
 class Field(Node):
+    __slots__ = ('_value', 'value_type', '_original_value')
+
     def __init__(self, el):
         super().__init__(el)
         text = (el.get('text') or (hasattr(el, 'text') and el.text) or '').strip()
@@ -45,7 +184,7 @@ class Field(Node):
             if 'time.' in _eval or 'obj().' in _eval or 'DateTime.' in _eval:
                 self._value = Unquoted(_eval)
             else:
-                self._value = safe_eval(_eval, globals_dict={'ref': Ref, 'Command': Command})
+                self._value = field_eval(_eval)
             self.value_type = 'eval'
         else:
             self._value = None
@@ -56,40 +195,48 @@ class Field(Node):
 # Records -----------------------------------------------
 
 class Record(Node):
+    __slots__ = ('tag', '_model', '_template', '_module', '_filename')
+    _keys = ('id', 'tag', '_model', '_template', '_module', 'children')
     _from = None
+    _registry = {}  # model -> Record subclass handling it, filled when the subclasses are defined
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The class of a record is changed to the one of its model, which needs the same layout
+        if '__slots__' not in cls.__dict__:
+            raise TypeError(f"{cls.__name__} must define __slots__ = () like the other records")
+        if cls.__dict__.get('_from'):
+            Record.register(cls._from, cls)
+
+    @staticmethod
+    def register(model, cls):
+        """Handle the records of `model` with `cls`, which must be a subclass of Record."""
+        Record._registry[model] = cls
+
     def __init__(self, el, tag, module):
         super().__init__(el)
-        self['tag'] = tag
-        self['_model'] = el.get('model')
+        self['tag'] = symbol(tag)
+        self['_model'] = symbol(el.get('model'))
         if self['_model'] == 'account.chart.template' and el.get('id'):
             self['_template'] = ref_module(el.get('id'), module)
-        self['_module'] = module
-        def get_all_subclasses(cls):
-            subclass_list = []
-            def recurse(klass):
-                for subclass in klass.__subclasses__():
-                    subclass_list.append(subclass)
-                    recurse(subclass)
-            recurse(cls)
-            return subclass_list
-        subclasses = get_all_subclasses(Record)
-        mapping = {cls._from: cls for cls in subclasses if cls._from}
-        target_cls = mapping.get(self['_model'])
+        self['_module'] = symbol(module)
+        target_cls = Record._registry.get(self['_model'])
         if target_cls:
             self.__class__ = target_cls
 
     def append(self, child):
         if not isinstance(child, Field):
             raise ValueError(f"Wrong child type {type(child)}, {child.get('_model')}")
-        children = self.get('children') or {}
+        # The slots are read directly, records get millions of fields
+        children = getattr(self, 'children', None) or {}
         child = self.cleanup(child)
         if not child.get('delete'):
-            children[child.get('id')] = child
-        self['children'] = children
+            children[child.id] = child
+        self.children = children
 
     def cleanup(self, child):
         value = child._value
-        record_id = child.get('id')
+        record_id = child.id
         if isinstance(value, str) and value.upper() in ('TRUE', 'FALSE'):
             child._value = {'TRUE': True, 'FALSE': False}.get(value.upper())
         if isinstance(value, str) and value == "None":
@@ -122,16 +269,12 @@ class Record(Node):
 
         if isinstance(value, (tuple, list)) and value and isinstance(value[0], str):
             value = [Command.set([
-                ref_module(v, self['_module'])
+                XmlidRefs([v], self['_module'])
                 for v in value
                 if v
             ])]
         elif isinstance(value, str):
-            value = ','.join(
-                ref_module(v, self['_module'])
-                for v in value.split(',')
-                if v
-            )
+            value = XmlidRefs([v for v in value.split(',') if v], self['_module'])
         elif isinstance(value, (tuple, list)):
             value = [v for v in value if v[0] != Command.CLEAR]
             for i, sub in enumerate(value):
@@ -149,17 +292,18 @@ class Record(Node):
                       sub[1] == 0 and
                       isinstance(sub[2], (list, tuple))):
                     if cls:
-                        sub = [sub[0], sub[1], [unquote_ref(x) for x in sub[2]]]
+                        sub = [sub[0], sub[1], [XmlidRefs([x], self['_module'], qualified=False) for x in sub[2]]]
                         value[i] = sub
                     else:
-                        value[i] = (Command.SET, 0, [ref_module(x, self['_module']) for x in sub[2]])
+                        value[i] = (Command.SET, 0, [XmlidRefs([x], self['_module']) for x in sub[2]])
                 elif (isinstance(sub, (list, tuple)) and
                       len(sub) in (2, 3) and
                       sub[0] == Command.LINK):
-                      value[i] = (Command.LINK, ref_module(sub[1], self['_module']))
+                      value[i] = (Command.LINK, XmlidRefs([sub[1]], self['_module']))
         return value
 
 class TemplateData(Record):
+    __slots__ = ()
     _from = 'account.chart.template'
     def cleanup(self, child):
         child = super().cleanup(child)
@@ -174,9 +318,11 @@ class TemplateData(Record):
         return child
 
 class AccountReconcileModel(Record):
+    __slots__ = ()
     _from = 'account.reconcile.model.template'
 
 class AccountReconcileModelLine(Record):
+    __slots__ = ()
     _from = 'account.reconcile.model.line.template'
 
     def cleanup(self, child):
@@ -187,9 +333,11 @@ class AccountReconcileModelLine(Record):
         return child
 
 class ResCompany(Record):
+    __slots__ = ()
     _from = 'res.company'
 
 class ResCountryGroup(Record):
+    __slots__ = ()
     _from = 'res.country.group'
     def cleanup(self, child):
         child = super().cleanup(child)
@@ -199,13 +347,16 @@ class ResCountryGroup(Record):
         return child
 
 class AccountTax(Record):
+    __slots__ = ()
     _from = 'account.tax.template'
     def cleanup(self, child):
         child = super().cleanup(child)
         record_id = child.get('id')
         if record_id.endswith('_id'):
-            # TODO: lazy that converts only if xmlid in known data
-            child._value = unquote_ref(str(child._value).split('.')[-1])
+            if child._value and (type(child._value) is str or isinstance(child._value, Ref)):
+                child._value = XmlidRefs([child._value], self['_module'], qualified=False)
+            else:
+                child._value = unquote_ref(str(child._value).split('.')[-1])
         elif record_id in ('invoice_repartition_line_ids', 'refund_repartition_line_ids'):
             child._value = self.cleanup_o2m(child, AccountTaxRepartitionLine)
             child['id'] = 'repartition_line_ids'
@@ -229,7 +380,11 @@ class AccountTax(Record):
         if previous_rep_lines and child.get('id') == 'repartition_line_ids':
             children['repartition_line_ids']._value = previous_rep_lines._value + children['repartition_line_ids']._value
 
+# xmlids of the report expressions of a repartition line, once joined by its cleanup
+_EXPRESSION_REF_RE = re.compile(r"'([^']+)'")
+
 class AccountTaxRepartitionLine(Record):
+    __slots__ = ()
     _from = 'account.tax.repartition.line'
     def cleanup(self, child):
         child = super().cleanup(child)
@@ -249,7 +404,7 @@ class AccountTaxRepartitionLine(Record):
         for name, child in self.get('children', {}).items():
             if name in ('plus_report_expression_ids', 'minus_report_expression_ids'):
                 sign = '+' if name == 'plus_report_expression_ids' else '-'
-                unformatted = [tags[ref_module(x, self['_module'])] for x in re.findall("'([^']+)'", child._value)]
+                unformatted = [tags[ref_module(x, self['_module'])] for x in _EXPRESSION_REF_RE.findall(child._value)]
                 tokens += [f"{sign}{t}" for t in unformatted]
                 to_be_removed.append(name)
         for name in to_be_removed:
@@ -258,6 +413,7 @@ class AccountTaxRepartitionLine(Record):
             self['children']['tag_ids'] = Field({'id': 'tag_ids', 'text': "||".join(tokens), 'unquoted': True})
 
 class AccountFiscalPosition(Record):
+    __slots__ = ()
     _from = 'account.fiscal.position'
     def cleanup(self, child):
         child = super().cleanup(child)
@@ -271,9 +427,11 @@ class AccountFiscalPosition(Record):
         return child
 
 class AccountFiscalPositionTemplate(AccountFiscalPosition):
+    __slots__ = ()
     _from = 'account.fiscal.position.template'
 
 class AccountAccount(Record):
+    __slots__ = ()
     _from = 'account.account'
     def cleanup(self, child):
         child = super().cleanup(child)
@@ -285,18 +443,23 @@ class AccountAccount(Record):
         return child
 
 class AccountAccountTemplate(AccountAccount):
+    __slots__ = ()
     _from = 'account.account.template'
 
 class AccountGroup(Record):
+    __slots__ = ()
     _from = 'account.group'
 
 class AccountGroupTemplate(AccountAccount):
+    __slots__ = ()
     _from = 'account.group.template'
 
 class AccountTaxGroup(Record):
+    __slots__ = ()
     _from = 'account.tax.group'
 
 class AccountFiscalPositionTaxTemplate(Record):
+    __slots__ = ()
     _from = 'account.fiscal.position.tax.template'
     def cleanup(self, child):
         child = super().cleanup(child)
@@ -306,6 +469,7 @@ class AccountFiscalPositionTaxTemplate(Record):
         return child
 
 class AccountFiscalPositionAccountTemplate(Record):
+    __slots__ = ()
     _from = 'account.fiscal.position.account.template'
     def cleanup(self, child):
         child = super().cleanup(child)
@@ -315,6 +479,7 @@ class AccountFiscalPositionAccountTemplate(Record):
         return child
 
 class AccountReport(Record):
+    __slots__ = ()
     _from = 'account.report'
     def cleanup(self, child):
         child = super().cleanup(child)
@@ -329,13 +494,12 @@ class AccountReport(Record):
                 yield from child['children']
                 break
 
-    def get_tags(self):
-        tags = {}
-        for line in self.get_lines():
-            tags.update(line.get_tags())
-        return tags
+    def get_tags(self, tags=None):
+        """Tags by expression xmlid of the whole report, added to `tags` if given."""
+        return collect_tags(self.get_lines(), {} if tags is None else tags)
 
 class AccountReportLine(Record):
+    __slots__ = ()
     _from = 'account.report.line'
     def cleanup(self, child):
         child = super().cleanup(child)
@@ -356,17 +520,12 @@ class AccountReportLine(Record):
                 yield from child['children']
                 break
 
-    def get_tags(self):
-        tags = {}
-        expressions = self.get_expressions()
-        for expression in expressions:
-            tags[ref_module(expression['id'], self['_module'])] = expression.get_tag_name()
-        for line in self.get_lines():
-            subtags = line.get_tags()
-            tags.update(subtags)
-        return tags
+    def get_tags(self, tags=None):
+        """Tags by expression xmlid of the line and its sub-lines, added to `tags` if given."""
+        return collect_tags([self], {} if tags is None else tags)
 
 class AccountReportExpression(Record):
+    __slots__ = ()
     _from = 'account.report.expression'
 
     def get_tag_name(self):
@@ -374,5 +533,18 @@ class AccountReportExpression(Record):
             if name == 'formula':
                 return child._value
 
-
-from transform_tools import Unquoted, Ref, unquote_ref, ref_module
+def collect_tags(lines, tags):
+    """
+        Add the tags of `lines` and their sub-lines to `tags`, walking them in document order without
+        recursion nor intermediate dicts.
+    """
+    stack = list(lines)[::-1]
+    while stack:
+        line = stack.pop()
+        for expression in line.get_expressions():
+            tags[ref_module(expression['id'], line['_module'])] = expression.get_tag_name()
+        stack.extend(list(line.get_lines())[::-1])
+    return tags
+
+
+from transform_tools import Unquoted, Ref, unquote_ref, ref_module, stats, symbol, XmlidRefs
@@ -0,0 +1,99 @@
+# pylint: skip-file
+from contextlib import contextmanager
+import cProfile
+import json
+import logging
+import os
+import time
+
+from transform_tools import stats, worker_state
+
+_logger = logging.getLogger(__name__)
+
+# Counters of `stats` attributed to the phase during which they grow
+PHASE_COUNTERS = ('files.read', 'bytes.read', 'files.written', 'bytes.written', 'records.read', 'records.translated')
+PHASE_METRICS = ('calls', 'wall', 'cpu') + PHASE_COUNTERS
+
+
+class Profiler():
+    """
+        Wall time, CPU time and counters of the phases of a run.
+        They are kept in `stats` under `phase.<name>.<metric>`, so that the phases run by the worker
+        processes of pool_map are reported too. The CPU time is the one of the process running the phase.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.stats_path = None  # directory of the cProfile dumps, one per phase
+        self._profiling = False
+        self._start = None
+
+    def start(self, stats_path=None):
+        self.enabled = True
+        self.stats_path = stats_path and os.path.expanduser(stats_path)
+        self._start = (time.perf_counter(), time.process_time())
+
+    @contextmanager
+    def phase(self, name):
+        """
+            Measure the enclosed code as the phase `name`, the measures of the phases with the same name add up.
+            Phases can be nested, only the outermost ones of a process are dumped with cProfile.
+        """
+        if not self.enabled:
+            yield
+            return
+        before = {counter: stats[counter] for counter in PHASE_COUNTERS}
+        profile = None
+        if self.stats_path and not self._profiling:
+            profile = cProfile.Profile()
+            self._profiling = True
+            profile.enable()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if profile:
+                profile.disable()
+                self._profiling = False
+                os.makedirs(self.stats_path, exist_ok=True)
+                profile.dump_stats(os.path.join(self.stats_path, f"{name.replace(':', '-')}.pstats"))
+            stats[f'phase.{name}.calls'] += 1
+            stats[f'phase.{name}.wall'] += wall
+            stats[f'phase.{name}.cpu'] += cpu
+            for counter in PHASE_COUNTERS:
+                stats[f'phase.{name}.{counter}'] += stats[counter] - before[counter]
+
+    def report(self, **info):
+        """The measures of the run so far, with `info` about it."""
+        phases = {}
+        counters = {}
+        for key, value in stats.items():
+            metric = key.startswith('phase.') and next((m for m in PHASE_METRICS if key.endswith(f'.{m}')), None)
+            if metric:
+                name = key[len('phase.'):-len(metric) - 1]
+                phases.setdefault(name, dict.fromkeys(PHASE_METRICS, 0))[metric] = value
+            else:
+                counters[key] = value
+        return {
+            **info,
+            'wall': time.perf_counter() - self._start[0],
+            'cpu': time.process_time() - self._start[1],
+            'phases': {
+                name: {metric.replace('.', '_'): value for metric, value in metrics.items()}
+                for name, metrics in phases.items()
+            },
+            'counters': counters,
+        }
+
+    def write_report(self, path, **info):
+        with open(os.path.expanduser(path), 'w', encoding='utf-8') as file:
+            json.dump(self.report(**info), file, indent=4)
+            file.write('\n')
+        _logger.info("profile written to %s%s", path, f", cProfile dumps in {self.stats_path}" if self.stats_path else '')
+
+profiler = Profiler()
+
+def _restore_profiler(settings):
+    profiler.enabled, profiler.stats_path = settings
+
+worker_state('profiler', lambda: (profiler.enabled, profiler.stats_path), _restore_profiler)
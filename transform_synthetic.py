@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# pylint: skip-file
+
+import argparse
+import csv
+import io
+from pathlib import Path
+import shutil
+
+
+ACCOUNT_TYPES = ('asset_receivable', 'liability_payable', 'asset_current', 'liability_current', 'income', 'expense')
+TAX_RATES = (0, 6, 12, 21)
+
+
+def write_file(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content, encoding='utf-8')
+
+def csv_content(header, rows):
+    stream = io.StringIO()
+    writer = csv.writer(stream, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows(rows)
+    return stream.getvalue()
+
+def xml_content(records):
+    return '<?xml version="1.0" encoding="utf-8"?>\n<odoo>\n' + ''.join(records) + '</odoo>\n'
+
+def po_content(lang, module, entries):
+    return (
+        '# Translation\n'
+        'msgid ""\n'
+        'msgstr ""\n'
+        '"Content-Type: text/plain; charset=UTF-8\\n"\n'
+        f'"Language: {lang}\\n"\n'
+    ) + ''.join(
+        f'\n#. module: {module}\n'
+        + ''.join(f'#: model:{model},name:{module}.{xmlid}\n' for model, xmlid in occurrences)
+        + f'msgid "{msgid}"\nmsgstr "{msgid} ({lang})"\n'
+        for msgid, occurrences in entries.items()
+    )
+
+# -----------------------------------------------------------
+
+def chart_template(module, chart):
+    return f"""    <record id="{chart}" model="account.chart.template">
+        <field name="name">{module} chart</field>
+        <field name="code_digits">6</field>
+        <field name="currency_id" ref="base.EUR"/>
+        <field name="country_id" ref="base.be"/>
+        <field name="bank_account_code_prefix">550</field>
+        <field name="cash_account_code_prefix">570</field>
+        <field name="transfer_account_code_prefix">580</field>
+        <field name="spoken_languages" eval="'fr_FR;nl_NL'"/>
+    </record>
+"""
+
+def chart_properties(module, chart):
+    return f"""    <record id="{chart}" model="account.chart.template">
+        <field name="property_account_receivable_id" ref="acc_0"/>
+        <field name="property_account_payable_id" ref="acc_1"/>
+        <field name="property_tax_payable_account_id" ref="acc_3"/>
+        <field name="property_tax_receivable_account_id" ref="acc_2"/>
+        <field name="income_currency_exchange_account_id" ref="acc_4"/>
+        <field name="default_pos_receivable_account_id" ref="acc_0"/>
+        <field name="use_anglo_saxon" eval="True"/>
+    </record>
+    <function model="account.chart.template" name="try_loading">
+        <value eval="[ref('{module}.{chart}')]"/>
+    </function>
+"""
+
+def tax_report(lines):
+    return """    <record id="tax_report" model="account.report">
+        <field name="name">Tax Report</field>
+        <field name="root_report_id" ref="account.generic_tax_report"/>
+        <field name="country_id" ref="base.be"/>
+        <field name="line_ids">
+            <record id="tax_report_title" model="account.report.line">
+                <field name="name">Operations</field>
+                <field name="sequence">1</field>
+                <field name="children_ids">
+""" + ''.join(f"""                    <record id="tax_report_line_{k}" model="account.report.line">
+                        <field name="name">{k:02d} - Grid</field>
+                        <field name="sequence">{k + 2}</field>
+                        <field name="expression_ids">
+                            <record id="tax_report_line_{k}_tag" model="account.report.expression">
+                                <field name="label">balance</field>
+                                <field name="engine">tax_tags</field>
+                                <field name="formula">{k:02d}</field>
+                            </record>
+                        </field>
+                    </record>
+""" for k in range(lines)) + """                </field>
+            </record>
+        </field>
+    </record>
+"""
+
+def repartition_lines(document_type, base_tag, tax_tag, account):
+    sign = 'plus' if document_type == 'invoice' else 'minus'
+    return f"""[(5, 0, 0),
+            (0, 0, {{
+                'repartition_type': 'base',
+                '{sign}_report_expression_ids': [ref('{base_tag}')],
+            }}),
+            (0, 0, {{
+                'repartition_type': 'tax',
+                'account_id': ref('{account}'),
+                '{sign}_report_expression_ids': [ref('{tax_tag}')],
+            }}),
+        ]"""
+
+def tax(chart, k, name, rate, lines, accounts):
+    base_tag, tax_tag, account = f"tax_report_line_{k % lines}_tag", f"tax_report_line_{(k + 1) % lines}_tag", f"acc_{k % accounts}"
+    return f"""    <record id="tax_{k}" model="account.tax.template">
+        <field name="chart_template_id" ref="{chart}"/>
+        <field name="name">{name}</field>
+        <field name="description">{rate}%</field>
+        <field name="amount">{rate}</field>
+        <field name="amount_type">percent</field>
+        <field name="type_tax_use">{'sale' if k % 2 else 'purchase'}</field>
+        <field name="price_include" eval="False"/>
+        <field name="tax_group_id" ref="tax_group_{rate}"/>
+        <field name="invoice_repartition_line_ids" eval="{repartition_lines('invoice', base_tag, tax_tag, account)}"/>
+        <field name="refund_repartition_line_ids" eval="{repartition_lines('refund', base_tag, tax_tag, account)}"/>
+    </record>
+"""
+
+def fiscal_position(chart, k):
+    return f"""    <record id="fpos_{k}" model="account.fiscal.position.template">
+        <field name="name">Fiscal position {k}</field>
+        <field name="chart_template_id" ref="{chart}"/>
+        <field name="sequence">{k}</field>
+        <field name="auto_apply" eval="True"/>
+        <field name="vat_required" eval="{k % 2 == 0}"/>
+    </record>
+"""
+
+def fiscal_position_tax(k, j, src, dest):
+    return f"""    <record id="fpos_{k}_tax_{j}" model="account.fiscal.position.tax.template">
+        <field name="position_id" ref="fpos_{k}"/>
+        <field name="tax_src_id" ref="tax_{src}"/>
+        <field name="tax_dest_id" ref="tax_{dest}"/>
+    </record>
+"""
+
+def fiscal_position_account(k, j, src, dest):
+    return f"""    <record id="fpos_{k}_account_{j}" model="account.fiscal.position.account.template">
+        <field name="position_id" ref="fpos_{k}"/>
+        <field name="account_src_id" ref="acc_{src}"/>
+        <field name="account_dest_id" ref="acc_{dest}"/>
+    </record>
+"""
+
+def reconcile_model(chart, k, accounts, taxes):
+    return f"""    <record id="reco_{k}" model="account.reconcile.model.template">
+        <field name="chart_template_id" ref="{chart}"/>
+        <field name="name">Write-off {k}</field>
+        <field name="rule_type">writeoff_button</field>
+    </record>
+""" + ''.join(f"""    <record id="reco_{k}_line_{j}" model="account.reconcile.model.line.template">
+        <field name="model_id" ref="reco_{k}"/>
+        <field name="account_id" ref="acc_{(k + j) % accounts}"/>
+        <field name="amount_type">percentage</field>
+        <field name="tax_ids" eval="[Command.set([ref('tax_{(k + j) % taxes}')])]"/>
+        <field name="amount_string">{50 if j else 100}</field>
+    </record>
+""" for j in range(2))
+
+# -----------------------------------------------------------
+
+def generate_module(path, module, accounts=100, csv_fiscal_positions=False, langs=('fr', 'nl')):
+    """
+        Write a localization in the old format to `path`: `accounts` accounts, and taxes, tax report lines,
+        fiscal positions and reconciliation models in proportion. The fiscal positions are in CSV files
+        if `csv_fiscal_positions` is set, in XML files otherwise.
+    """
+    chart = f"{module}_chart_template"
+    taxes = max(2, accounts // 5)
+    lines = max(2, taxes // 2)
+    fiscal_positions = max(1, accounts // 100)
+    mappings = min(taxes, 10)
+    reconcile_models = max(1, accounts // 200)
+
+    account_names = [
+        f'Sales, "goods" {k}' if k % 7 == 0 else f"Account {k}"
+        for k in range(accounts)
+    ]
+    tax_names = [f"VAT {TAX_RATES[k % len(TAX_RATES)]}% {k}" for k in range(taxes)]
+
+    data = [
+        f'data/{module}_chart_data.xml',
+        'data/account.account.template.csv',
+        'data/account.group.template.csv',
+        'data/account.tax.group.csv',
+        'data/account_tax_report_data.xml',
+        'data/account_tax_data.xml',
+    ] + ([
+        'data/account.fiscal.position.template.csv',
+        'data/account.fiscal.position.tax.template.csv',
+        'data/account.fiscal.position.account.template.csv',
+    ] if csv_fiscal_positions else [
+        'data/account_fiscal_position_data.xml',
+    ]) + [
+        'data/account_reconcile_model_data.xml',
+        'data/account_chart_template_data.xml',
+    ]
+    write_file(path / '__init__.py', '# -*- coding: utf-8 -*-\n')
+    write_file(path / '__manifest__.py', (
+        "{\n"
+        f"    'name': '{module} - Accounting',\n"
+        "    'version': '1.0',\n"
+        "    'depends': ['account', 'l10n_multilang'],\n"
+        "    'data': [\n"
+        + ''.join(f"        '{filename}',\n" for filename in data) +
+        "    ],\n"
+        "    'license': 'LGPL-3',\n"
+        "}\n"
+    ))
+
+    write_file(path / f'data/{module}_chart_data.xml', xml_content([chart_template(module, chart)]))
+    write_file(path / 'data/account.account.template.csv', csv_content(
+        ['id', 'name', 'code', 'account_type', 'reconcile', 'chart_template_id:id'],
+        [
+            [f"acc_{k}", name, 100000 + k * 10, ACCOUNT_TYPES[k % len(ACCOUNT_TYPES)], 'TRUE' if k % 6 < 2 else 'FALSE', chart]
+            for k, name in enumerate(account_names)
+        ],
+    ))
+    write_file(path / 'data/account.group.template.csv', csv_content(
+        ['id', 'name', 'code_prefix_start', 'code_prefix_end', 'chart_template_id:id'],
+        [
+            [f"group_{prefix}", f"Group {prefix}", prefix, prefix, chart]
+            for prefix in sorted({str(100000 + k * 10)[:3] for k in range(accounts)})
+        ],
+    ))
+    write_file(path / 'data/account.tax.group.csv', csv_content(
+        ['id', 'name', 'sequence', 'country_id:id', 'property_tax_payable_account_id:id'],
+        [[f"tax_group_{rate}", f"VAT {rate}%", k, 'base.be', 'acc_3'] for k, rate in enumerate(TAX_RATES)],
+    ))
+    write_file(path / 'data/account_tax_report_data.xml', xml_content([tax_report(lines)]))
+    write_file(path / 'data/account_tax_data.xml', xml_content([
+        tax(chart, k, name, TAX_RATES[k % len(TAX_RATES)], lines, accounts)
+        for k, name in enumerate(tax_names)
+    ]))
+
+    mapped_taxes = [(k, j, j, (j + 1) % taxes) for k in range(fiscal_positions) for j in range(mappings)]
+    mapped_accounts = [(k, j, j, (j + 1) % accounts) for k in range(fiscal_positions) for j in range(min(accounts, 5))]
+    if csv_fiscal_positions:
+        write_file(path / 'data/account.fiscal.position.template.csv', csv_content(
+            ['id', 'name', 'chart_template_id:id', 'sequence', 'auto_apply', 'vat_required'],
+            [[f"fpos_{k}", f"Fiscal position {k}", chart, k, 1, int(k % 2 == 0)] for k in range(fiscal_positions)],
+        ))
+        write_file(path / 'data/account.fiscal.position.tax.template.csv', csv_content(
+            ['id', 'position_id:id', 'tax_src_id:id', 'tax_dest_id:id'],
+            [[f"fpos_{k}_tax_{j}", f"fpos_{k}", f"tax_{src}", f"tax_{dest}"] for k, j, src, dest in mapped_taxes],
+        ))
+        write_file(path / 'data/account.fiscal.position.account.template.csv', csv_content(
+            ['id', 'position_id:id', 'account_src_id:id', 'account_dest_id:id'],
+            [[f"fpos_{k}_account_{j}", f"fpos_{k}", f"acc_{src}", f"acc_{dest}"] for k, j, src, dest in mapped_accounts],
+        ))
+    else:
+        write_file(path / 'data/account_fiscal_position_data.xml', xml_content(
+            [fiscal_position(chart, k) for k in range(fiscal_positions)]
+            + [fiscal_position_tax(*mapping) for mapping in mapped_taxes]
+            + [fiscal_position_account(*mapping) for mapping in mapped_accounts]
+        ))
+
+    write_file(path / 'data/account_reconcile_model_data.xml', xml_content([
+        reconcile_model(chart, k, accounts, taxes) for k in range(reconcile_models)
+    ]))
+    write_file(path / 'data/account_chart_template_data.xml', xml_content([chart_properties(module, chart)]))
+
+    entries = {
+        **{name: [('account.account.template', f"acc_{k}")] for k, name in enumerate(account_names) if '"' not in name},
+        **{name: [('account.tax.template', f"tax_{k}"), ('account.tax', f"1_tax_{k}")] for k, name in enumerate(tax_names)},
+    }
+    for lang in langs:
+        write_file(path / f'i18n/{lang}.po', po_content(lang, module, entries))
+
+def generate_addons(path, modules=2, accounts=100, langs=('fr', 'nl')):
+    """
+        Write a fake `addons` directory with `modules` localizations of `accounts` accounts each,
+        replacing the l10n modules already there. Every other localization has its fiscal positions in CSV.
+    """
+    path = Path(path)
+    for module_path in path.glob('l10n_*'):
+        shutil.rmtree(module_path)
+    names = [f"l10n_synth{i}" for i in range(modules)]
+    for i, module in enumerate(names):
+        generate_module(path / module, module, accounts, csv_fiscal_positions=bool(i % 2), langs=langs)
+    return names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate fake localizations in the old format, to measure the transformation.")
+    parser.add_argument('path', help="addons directory to generate the localizations into")
+    parser.add_argument('-m', '--modules', type=int, default=2, help="number of localizations")
+    parser.add_argument('-a', '--accounts', type=int, default=100, help="number of accounts per localization, the other records are in proportion")
+    parser.add_argument('-l', '--langs', default='fr,nl', help="comma separated languages of the PO files")
+    args = parser.parse_args()
+    generate_addons(args.path, args.modules, args.accounts, tuple(filter(None, args.langs.split(','))))
@@ -1,8 +1,25 @@
 #!/usr/bin/env python3
 # pylint: skip-file
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import difflib
+from fnmatch import fnmatchcase
+from functools import lru_cache, partial
 import io
-from pathlib import Path
+import itertools
+import logging
+import multiprocessing
+import os
+from pathlib import Path, PurePath
+import pickle
+from sys import intern
+import tempfile
+
+from config import ODOO_PATH, WRITE_THREADS
+
+_logger = logging.getLogger(__name__)
 
 
 def get_command(x):
@@ -10,76 +27,88 @@ def get_command(x):
 
 
 def pformat(item, level=0, stream=None):
+    """Format `item` as Python code, indented at `level`."""
+    stream = stream or io.StringIO()
+    write_pformat(stream, item, level)
+    return stream.getvalue()
 
-    def pformat_field_record(value, stream):
-        stream.write(pformat(value.get('children', {}), level=level))
 
-    def pformat_tuple_list(value, stream):
+def write_pformat(stream, item, level=0, lstrip=False, strip=False):
+    """
+        Write `item` formatted as Python code in `stream`, without building intermediate strings.
+        `lstrip` and `strip` give the same output as applying them to the result of pformat.
+    """
+    write = stream.write
+
+    def write_leaf(value, lstrip, strip):
+        write(value.strip() if strip else value.lstrip() if lstrip else value)
+
+    def write_tuple_list(value, level, lstrip):
         start, end = '[]' if isinstance(value, list) else '()'
-        stream.write(indent(level, start + '\n'))
+        write(start + '\n' if lstrip else indent(level, start + '\n'))
         is_o2m = all([isinstance(sub, (tuple, list))
                       and len(sub) in (2, 3)
                       and isinstance(sub[0], int)
                       for sub in value])
-        for i, subitem in enumerate(value):
+        write_value = None
+        for subitem in value:
             if is_o2m:
                 subitem = list(subitem)
                 if subitem == [5, 0, 0]:
-                    value_str = Unquoted("Command.clear()")
+                    write_value = partial(write, "Command.clear()")
                 elif len(subitem) == 3:
-                    subvalue_str = pformat(subitem[2], level+1).strip()
-                    name = get_command(subitem[0])
-                    value_str = Unquoted(f"Command.{name}({subvalue_str})")
+                    write_value = partial(write_command, get_command(subitem[0]), subitem[2], level + 1)
                 elif len(subitem) in (2, 3) and subitem[0] == 4:
-                    subvalue_str = pformat(subitem[1], level+1).strip()
-                    name = get_command(subitem[0])
-                    value_str = Unquoted(f"Command.{name}({subvalue_str})")
+                    write_value = partial(write_command, get_command(subitem[0]), subitem[1], level + 1)
+                elif write_value is None:
+                    raise ValueError(f"Unsupported command {subitem}")
+                # else the previous command is written again
             else:
-                value_str = repr(subitem)
-            comma = ',' if i < len(value) else ''
-            stream.write(indent(level + 1, f"{value_str}{comma}\n"))
-        stream.write(indent(level, end))
-
-    def pformat_dict(value, stream):
-        stream.write(indent(level, '{\n'))
-        for i, (key, subitem) in enumerate(value.items()):
-            if isinstance(subitem, Field):
-                subvalue = subitem._value
-            else:
-                subvalue = subitem
-            value_str = pformat(subvalue, level + 1).lstrip()
-            comma = ',' if i < len(value) else ''
-            stream.write(indent(level + 1, f"{repr(key)}: {value_str}{comma}\n"))
-        stream.write(indent(level, '}\n'))
-
-    def pformat_str(value, stream):
-        if '\n' in value:
-            stream.write(f'''"""{value}"""''')
-        else:
-            stream.write(repr(value))
+                write_value = partial(write, repr(subitem))
+            write(indent(level + 1))
+            write_value()
+            write(",\n")
+        write(indent(level, end))
 
-    stream = stream or io.StringIO()
-    mapping = [
-        ((Field, Record), pformat_field_record),
-        ((tuple, list), pformat_tuple_list),
-        ((dict,), pformat_dict),
-        ((str,), pformat_str),
-    ]
-    for types, formatter in mapping:
-        if isinstance(item, types):
-            formatter(item, stream)
-            break
-    else:
-        stream.write(indent(level, repr(item)))
+    def write_command(name, value, level):
+        write(f"Command.{name}(")
+        write_item(value, level, lstrip=True, strip=True)
+        write(")")
 
-    return stream.getvalue()
+    def write_dict(value, level, lstrip, strip):
+        write('{\n' if lstrip or strip else indent(level, '{\n'))
+        for key, subitem in value.items():
+            write(indent(level + 1, f"{repr(key)}: "))
+            write_item(subitem._value if isinstance(subitem, Field) else subitem, level + 1, lstrip=True)
+            write(",\n")
+        write(indent(level, '}' if strip else '}\n'))
+
+    def write_item(item, level, lstrip=False, strip=False):
+        if isinstance(item, (Field, Record)):
+            write_item(item.get('children', {}), level, lstrip, strip)
+        elif isinstance(item, (tuple, list)):
+            write_tuple_list(item, level, lstrip or strip)
+        elif isinstance(item, dict):
+            write_dict(item, level, lstrip, strip)
+        elif isinstance(item, str):
+            write_leaf(f'''"""{item}"""''' if '\n' in item else repr(item), lstrip, strip)
+        else:
+            write_leaf(indent(level, repr(item)), lstrip, strip)
 
+    write_item(item, level, lstrip, strip)
+
+def symbol(value):
+    """
+        The interned `value` if it is a string, so that the identifiers repeated across the files
+        (modules, models, field names, xmlids) are a single object and compare by identity.
+    """
+    return intern(value) if type(value) is str else value
 
 def unquote_ref(value):
-    return f"{str(value).split('.')[-1]}"
+    return symbol(str(value).split('.')[-1])
 
 def ref_module(value, module):
-    return value if '.' in str(value) else f"{module}.{value}"
+    return symbol(value) if '.' in str(value) else symbol(f"{module}.{value}")
 
 class Unquoted(str):
     def __init__(self, value):
@@ -89,21 +118,371 @@ class Unquoted(str):
         return self._value
 
 class Ref():
+    __slots__ = ('value',)
+
     def __init__(self, value):
-        self.value = str(value)
+        self.value = symbol(str(value))
+
+    def __setstate__(self, state):
+        _dict, slots = state
+        self.value = symbol(slots['value'])
+
     def __repr__(self):
         return f"'{self.value}'"
     def __str__(self):
         return self.value
 
+class XmlidIndex():
+    """
+        Records by xmlid, with their model and module, filled while the data files are read.
+        The references are resolved against it once all the data files are read, the unknown ones
+        are gathered to be reported together.
+    """
+    def __init__(self):
+        self.records = {}  # xmlid -> (model, module, record)
+        self.modules = set()  # modules whose records are all indexed
+        self.unknown = {}  # xmlid of an indexed module that isn't known -> modules referencing it
+        self._resolved = {}  # (reference, module) -> xmlid
+
+    def add(self, xmlid, model, module, record):
+        self.records.setdefault(xmlid, (model, module, record))
+
+    def resolve(self, value, module):
+        """The xmlid of a reference made in `module`, normalized once."""
+        key = (value, module)
+        xmlid = self._resolved.get(key)
+        if xmlid is None:
+            xmlid = self._resolved[key] = ref_module(value, module)
+            if xmlid.split('.')[0] in self.modules and xmlid not in self.records:
+                self.report(xmlid, module)
+        return xmlid
+
+    def report(self, xmlid, module):
+        """Report `xmlid`, referenced in `module`, as unknown."""
+        self.unknown.setdefault(xmlid, set()).add(module)
+
+    def take_unknown(self):
+        """The unknown references met since the last call."""
+        unknown, self.unknown = self.unknown, {}
+        return unknown
+
+    def clear(self):
+        self.__init__()
+
+xmlids = XmlidIndex()
+
+class XmlidRefs():
+    """
+        References made in `module` to records, kept as they are written in the data files until all
+        of them are read. They are then resolved against `xmlids` and replaced by their `str`, the
+        xmlids separated by commas, with their module if `qualified`. Otherwise the module is only
+        removed from the known xmlids, the other references are written as they are and reported.
+    """
+    __slots__ = ('values', 'module', 'qualified')
+
+    def __init__(self, values, module, qualified=True):
+        self.values = tuple(symbol(str(value)) for value in values)
+        self.module = module
+        self.qualified = qualified
+
+    def __str__(self):
+        resolved = [xmlids.resolve(value, self.module) for value in self.values]
+        if self.qualified:
+            return ','.join(resolved)
+        written = []
+        for value, xmlid in zip(self.values, resolved):
+            if xmlid in xmlids.records:
+                written.append(unquote_ref(xmlid))
+            else:
+                xmlids.report(xmlid, self.module)
+                written.append(value)
+        return ','.join(written)
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __bool__(self):
+        return bool(self.values)
+
 def indent(level=0, content="", indent_size=4):
     return f"{' ' * level * indent_size}{content}"
 
+@lru_cache(maxsize=None)
+def l10n_addons():
+    """Paths of the l10n addons by module name, in the order of the addons directory."""
+    addons_path = Path.cwd() / f'{ODOO_PATH}/addons'
+    with os.scandir(addons_path) as addons:
+        return {
+            symbol(addon.name): addons_path / addon.name
+            for addon in addons
+            if addon.name.startswith('l10n_') and addon.is_dir()
+        }
+
+@lru_cache(maxsize=None)
+def module_files(module):
+    """
+        Scan a l10n addon once and classify the files used by the transformation.
+        The files are listed in the same order as Path.glob would yield them.
+
+        :return: {'path', 'manifest', 'data_csv', 'data_xml', 'demo_xml', 'po'}
+    """
+    def scan_files(path, pattern):
+        with os.scandir(path) as entries:
+            return [Path(path) / entry.name for entry in entries if fnmatchcase(entry.name, pattern) and entry.is_file()]
+
+    path = l10n_addons().get(module)
+    files = {
+        'path': path,
+        'manifest': None,
+        'data_csv': [],
+        'data_xml': [],
+        'demo_xml': [],
+        'po': [],
+    }
+    if not path:
+        return files
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name == '__manifest__.py' and entry.is_file():
+                files['manifest'] = path / entry.name
+            elif entry.name == 'data' and entry.is_dir():
+                files['data_csv'] = scan_files(entry.path, '*.csv')
+                files['data_xml'] = scan_files(entry.path, '*.xml')
+            elif entry.name == 'demo' and entry.is_dir():
+                files['demo_xml'] = scan_files(entry.path, '*.xml')
+            elif fnmatchcase(entry.name, 'i18n*') and entry.is_dir():
+                files['po'] += scan_files(entry.path, '*.po*')
+    return files
+
+def addons_inventory(modules=None):
+    """Files of the given l10n modules (all of them by default), see `module_files`."""
+    return {
+        module: module_files(module)
+        for module in l10n_addons()
+        if modules is None or module in modules
+    }
+
+def select_modules(args):
+    """
+        Resolve command line arguments to the names of the l10n modules to transform, None meaning all of them.
+        An argument is a module name, a glob on the module names, or the path of an addon, of a file
+        in an addon, of a directory containing addons or of a directory containing the addons directory.
+
+        :raise ValueError: if no module matches the arguments
+    """
+    if not args:
+        return None
+    modules = {}
+    for arg in args:
+        parts = PurePath(arg).parts
+        if 'addons' in parts:
+            after_addons = parts[len(parts) - parts[::-1].index('addons'):]
+            pattern = after_addons[0] if after_addons else '*'
+        elif Path(arg, 'addons').is_dir():
+            pattern = '*'
+        elif len(parts) == 1:
+            pattern = arg
+        else:
+            pattern = next((part for part in parts if fnmatchcase(part, 'l10n_*')), None)
+        matches = [module for module in l10n_addons() if pattern and fnmatchcase(module, pattern)]
+        if not matches:
+            _logger.warning("No l10n module matches %s", arg)
+        modules.update(dict.fromkeys(matches))
+    if not modules:
+        raise ValueError(f"No l10n module matches {' '.join(args)}")
+    return list(modules)
+
+class Changeset():
+    """
+        Writes and deletions of files, staged in memory until they are applied at the end of the run.
+        Reading a file through the changeset gives its staged content.
+    """
+    def __init__(self):
+        self.changes = {}  # absolute path -> new content, None if the file is deleted
+        self.journal = []  # (absolute path, content) in the order of the changes
+
+    def _stage(self, path, content):
+        path = os.path.abspath(path)
+        self.changes[path] = content
+        self.journal.append((path, content))
+
+    def write(self, path, content):
+        self._stage(path, content)
+
+    def delete(self, path):
+        self._stage(path, None)
+
+    def replay(self, journal):
+        for path, content in journal:
+            self._stage(path, content)
+
+    def restore(self, changes):
+        """Replace the staged changes by the ones of another process, without their journal."""
+        self.discard()
+        self.changes.update(changes)
+
+    def exists(self, path):
+        path = os.path.abspath(path)
+        if path in self.changes:
+            return self.changes[path] is not None
+        return os.path.exists(path)
+
+    def read(self, path, mode='r'):
+        path = os.path.abspath(path)
+        if path in self.changes:
+            content = self.changes[path]
+            if content is None:
+                raise FileNotFoundError(path)
+            return content.encode() if 'b' in mode else content
+        with open(path, mode, **({} if 'b' in mode else {'encoding': 'utf-8'})) as file:
+            stats['files.read'] += 1
+            stats['bytes.read'] += os.fstat(file.fileno()).st_size
+            return file.read()
+
+    def summary(self):
+        lines = []
+        for path, content in sorted(self.changes.items()):
+            status = 'deleted' if content is None else 'modified' if os.path.exists(path) else 'created'
+            lines.append(f"{status:>8} {os.path.relpath(path)}")
+        return '\n'.join(lines + [f"{len(self.changes)} file(s) changed"])
+
+    def diff(self):
+        diff = []
+        for path, content in sorted(self.changes.items()):
+            original = ''
+            if os.path.exists(path):
+                with open(path, encoding='utf-8', errors='replace') as file:
+                    original = file.read()
+            diff += difflib.unified_diff(
+                original.splitlines(keepends=True),
+                (content or '').splitlines(keepends=True),
+                f"a/{os.path.relpath(path)}",
+                f"b/{os.path.relpath(path)}" if content is not None else '/dev/null',
+            )
+        return ''.join(diff)
+
+    @staticmethod
+    def _apply_change(path, content):
+        """Write or delete a file, return the number of bytes written, None for a deletion."""
+        if content is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            return file.write(content.encode('utf-8'))
+
+    def apply(self, threads=WRITE_THREADS):
+        """
+            Write the staged changes to the disk and empty the changeset.
+            The files are written by a pool of `threads` threads, each file once with its last staged content.
+            All the changes are attempted, then the failures are logged in the order of the paths and the
+            first one is raised, the changeset is left as it is in that case.
+        """
+        changes = sorted(self.changes.items())
+        with ThreadPoolExecutor(max(threads, 1)) as pool:
+            futures = [pool.submit(self._apply_change, path, content) for path, content in changes]
+        errors = []
+        for (path, _content), future in zip(changes, futures):
+            if future.exception():
+                errors.append((path, future.exception()))
+            elif future.result() is not None:
+                stats['files.written'] += 1
+                stats['bytes.written'] += future.result()
+        for path, error in errors:
+            _logger.error("Could not write %s: %s", os.path.relpath(path), error)
+        if errors:
+            raise errors[0][1]
+        self.discard()
+
+    def discard(self, paths=None):
+        """Empty the changeset without writing anything, or only forget the changes of the given files."""
+        if paths is None:
+            self.changes.clear()
+            self.journal.clear()
+            return
+        paths = {os.path.abspath(path) for path in paths}
+        for path in paths & self.changes.keys():
+            del self.changes[path]
+        self.journal[:] = [(path, content) for path, content in self.journal if path not in paths]
+
+changeset = Changeset()
+stats = Counter()  # counters of the run, pool_map adds the ones of the worker processes
+
+_worker_states = {}  # name -> (get, restore) of the state of this process sent to the worker processes
+
+def worker_state(name, get, restore):
+    """
+        Send `get()` to the worker processes with each pool_map call, `restore` is called with it in the
+        workers before they run the tasks of the call. The workers don't rely on the memory they inherit
+        from this process, so that they behave the same whatever the start method of multiprocessing.
+        `restore` is sent by reference: it must be a function defined at the top level of its module,
+        which the workers import if needed.
+    """
+    _worker_states[name] = (get, restore)
+
+def _restore_changeset(changes):
+    changeset.restore(changes)
+
+worker_state('changeset', lambda: changeset.changes, _restore_changeset)
+
+_pool = None  # worker processes of the current run, see worker_pool
+_calls = itertools.count()  # numbers of the pool_map calls, identifying the state they send
+_restored_call = None  # number of the call whose state was last restored by this worker process
+
+@contextmanager
+def worker_pool(jobs=1):
+    """Start the worker processes used by all the pool_map calls of a run, and stop them at the end of it."""
+    global _pool
+    if jobs <= 1 or _pool is not None:
+        yield
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        _pool = pool
+        try:
+            yield
+        finally:
+            _pool = None
+
+def _staged_call(func, state, arg):
+    """
+        Call func in a worker process with the state of the parent process, and send back the changes it
+        staged and its counters along with its result.
+    """
+    global _restored_call
+    call, state_path = state
+    if call != _restored_call:
+        with open(state_path, 'rb') as file:
+            for restore, value in pickle.load(file).values():
+                restore(value)
+        _restored_call = call
+    start = len(changeset.journal)
+    before = stats.copy()
+    return func(arg), changeset.journal[start:], stats - before
+
+def pool_map(func, iterable, jobs=1):
+    """
+        Same as `map`, but fanned out over the `jobs` worker processes of the run (see worker_pool).
+        The results keep the order of the input and the changes staged by the workers are replayed in that
+        order in the changeset of this process. The counters of the workers are added to the `stats` of this process.
+        The state registered with worker_state is written once per call to a temporary file read by each worker.
+    """
+    if jobs <= 1:
+        return map(func, iterable)
+    if _pool is None:
+        with worker_pool(jobs):
+            return pool_map(func, iterable, jobs)
+    with tempfile.NamedTemporaryFile(prefix='transform_coa-', suffix='.pickle') as state:
+        pickle.dump({name: (restore, get()) for name, (get, restore) in _worker_states.items()}, state, pickle.HIGHEST_PROTOCOL)
+        state.flush()
+        results = []
+        for result, journal, worker_stats in _pool.map(partial(_staged_call, func, (next(_calls), state.name)), iterable, chunksize=1):
+            changeset.replay(journal)
+            stats.update(worker_stats)
+            results.append(result)
+        return results
+
 def save_new_file(path, filename, content):
-    path = Path.cwd() / path
-    if not path.is_dir():
-        path.mkdir()
-    with open(str(path / filename), 'w', encoding="utf-8") as outfile:
-        outfile.write(content)
+    changeset.write(Path.cwd() / path / filename, content)
 
 from transform_models import Field, Record